@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+#
+#   roundtrip.py - benchmark dumping to and reloading from norbert format
+#
+#   Copyright (C) 2012-2013 DMBuce <dmbuce@gmail.com>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with this program; if not, write to the Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import os
+import shutil
+import sys
+import tempfile
+
+import synth
+import norbert
+
+SIZES = [ 1000, 10000, 100000 ]
+SHAPES = {
+    "list":     synth.long_list,
+    "compound": synth.wide_compound,
+}
+
+# the largest size to also load without an index, which is quadratic
+UNINDEXED_MAX = 10000
+
+# equivalent of norbert -d 0 -p norbert -f infile >outfile
+def dump(infile, outfile):
+    options = synth.Options(infile=infile)
+    nbtfile = norbert.read_file(options, [])
+    with open(outfile, 'w') as f:
+        norbert.print_subtags(nbtfile, maxdepth=0, format="norbert", out=f)
+
+# equivalent of norbert -d 0 -i norbert -f infile
+def load(infile):
+    options = synth.Options(infile=infile, inputformat="norbert")
+    return norbert.read_file(options, [])
+
+# load a norbert file with norbert_add_tag's unindexed lookups
+def load_unindexed(infile):
+    nbtfile = norbert.nbt.NBTFile()
+    with open(infile) as f:
+        for line in f:
+            names, tag = norbert.norbert_parse_line(line)
+            norbert.norbert_add_tag(nbtfile, names, tag)
+    return nbtfile
+
+def main():
+    tmpdir = tempfile.mkdtemp()
+    nbtpath = os.path.join(tmpdir, "list.dat")
+    norbertpath = os.path.join(tmpdir, "list.norbert")
+
+    print("%10s %10s %10s %10s %10s %12s" % ("shape", "children", "lines",
+                                             "dump", "load", "unindexed"))
+    try:
+        for shape, n in [ (s, n) for s in SHAPES for n in SIZES ]:
+            SHAPES[shape](n).write_file(nbtpath)
+            dumptime, ret = synth.timed(dump, nbtpath, norbertpath)
+            loadtime, ret = synth.timed(load, norbertpath)
+            if n <= UNINDEXED_MAX:
+                slowtime, ret = synth.timed(load_unindexed, norbertpath)
+                slowtime = "%12.4f" % slowtime
+            else:
+                slowtime = "%12s" % "-"
+
+            with open(norbertpath) as f:
+                lines = sum(1 for line in f)
+            print("%10s %10d %10d %10.4f %10.4f %s" % (shape, n, lines,
+                                                       dumptime, loadtime,
+                                                       slowtime))
+    finally:
+        shutil.rmtree(tmpdir)
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
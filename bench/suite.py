@@ -0,0 +1,338 @@
+#!/usr/bin/env python
+#
+#   suite.py - benchmark norbert's entry points on synthetic NBT trees
+#
+#   Copyright (C) 2012-2013 DMBuce <dmbuce@gmail.com>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with this program; if not, write to the Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import io
+import json
+import optparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import tracemalloc
+
+import synth
+import norbert
+from norbert import diff
+
+DEFAULT_SIZE = 10000
+DEFAULT_REPEAT = 3
+DEFAULT_THRESHOLD = 25
+
+SHAPES = {
+    "list":     synth.long_list,
+    "compound": synth.wide_compound,
+    "deep":     synth.deep_compound,
+    "arrays":   synth.big_arrays,
+    "signs":    synth.sign_texts,
+    "strings":  synth.escaped_strings,
+}
+
+# the directory norbert.py is in
+TOPDIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+
+# the most tags looked up and set by the get_tag and set_tag benchmarks
+LOOKUPS = 1000
+
+# the (compression level, threads) of each write_file benchmark
+WRITES = [ (0, 1), (1, 1), (6, 1), (9, 1), (9, 4) ]
+
+# a text file that only counts the characters or bytes written to it. It is
+# its own buffer, for the nbt formatter
+class CountingFile(object):
+    def __init__(self):
+        self.size = 0
+        self.buffer = self
+
+    def write(self, data):
+        self.size += len(data)
+
+    def flush(self):
+        pass
+
+def parse_args():
+    usage = "%prog [options] [shape] [shape2] ..."
+    desc  = "Times norbert's readers, tag lookups, traversal, writers " \
+            "and formatters on synthetic NBT trees of each <shape>, or " \
+            "of every shape if none are given. Shapes are " + \
+            ", ".join(sorted(SHAPES)) + ". The startup shape times " \
+            "starting a new norbert process."
+    parser = optparse.OptionParser(usage=usage, description=desc)
+    parser.add_option("-n", "--size",
+                      dest="size",
+                      type="int",
+                      default=DEFAULT_SIZE,
+                      help="The size of each tree, in children of its " \
+                           "largest tag. Default is %d." % DEFAULT_SIZE)
+    parser.add_option("-r", "--repeat",
+                      dest="repeat",
+                      type="int",
+                      default=DEFAULT_REPEAT,
+                      help="Time each benchmark this many times and " \
+                           "report the fastest. Default is %d." %
+                           DEFAULT_REPEAT)
+    parser.add_option("--save",
+                      dest="save",
+                      default=None,
+                      help="Save the results to SAVE, as a baseline for " \
+                           "--compare.")
+    parser.add_option("--compare",
+                      dest="compare",
+                      default=None,
+                      help="Compare the results to a baseline saved with " \
+                           "--save, and exit with status 1 if any " \
+                           "benchmark is slower by more than the " \
+                           "threshold.")
+    parser.add_option("--threshold",
+                      dest="threshold",
+                      type="int",
+                      default=DEFAULT_THRESHOLD,
+                      help="The percentage a benchmark may be slower than " \
+                           "the baseline before it is a regression. " \
+                           "Default is %d." % DEFAULT_THRESHOLD)
+
+    (options, args) = parser.parse_args()
+    for shape in args:
+        if shape not in SHAPES and shape != "startup":
+            parser.error("unknown shape: " + shape)
+    if len(args) == 0:
+        args = ["startup"] + sorted(SHAPES)
+
+    return (options, args)
+
+# returns: a list of (operation, fn, count) benchmarks for a tree, where
+#          fn() does the operation and returns the number of bytes it read
+#          or wrote, or None, and count is the number of tags it handles
+def benchmarks(root, tmpdir):
+    nbtpath = os.path.join(tmpdir, "bench.dat")
+    norbertpath = os.path.join(tmpdir, "bench.norbert")
+    root.write_file(nbtpath)
+    with open(norbertpath, 'w') as f:
+        norbert.print_subtags(root, maxdepth=0, format="norbert", out=f)
+
+    tags = synth.count_tags(root)
+    nbtsize = os.path.getsize(nbtpath)
+    norbertsize = os.path.getsize(norbertpath)
+    scriptpath = os.path.join(tmpdir, "bench.edit")
+    nbtoptions = synth.Options(infile=nbtpath)
+    norbertoptions = synth.Options(infile=norbertpath,
+                                   inputformat="norbert")
+    editoptions = synth.Options(infile=nbtpath, editscript=scriptpath)
+
+    # names and values of evenly spaced leaves, without the root's name
+    with open(norbertpath) as f:
+        lines = f.readlines()
+    step = max(1, len(lines) // LOOKUPS)
+    leaves = []
+    for line in lines[::step][:LOOKUPS]:
+        (name, tagtype, value) = norbert.norbert_split_line(line.rstrip('\n'),
+                                                            '=')
+        if tagtype not in norbert.complex_tag_types:
+            leaves.append( (name.partition('/')[2], value) )
+
+    tree = norbert.nbt_read_file(nbtoptions)
+    found = [ (norbert.get_tag(tree, name), value)
+              for (name, value) in leaves ]
+
+    # the same leaves, set to the same values by an edit script
+    with open(scriptpath, 'w') as f:
+        for (name, value) in leaves:
+            f.write("%s=%s\n" % (name, norbert.norbert_escape(value)))
+
+    def read_nbt():
+        norbert.nbt_read_file(nbtoptions)
+        return nbtsize
+
+    def read_norbert():
+        norbert.norbert_read_file(norbertoptions)
+        return norbertsize
+
+    def get_tags():
+        for (name, value) in leaves:
+            norbert.get_tag(tree, name)
+
+    def set_tags():
+        for (tag, value) in found:
+            norbert.set_tag(tag, value)
+
+    def edit_tags():
+        norbert.norbert_edit(tree, editoptions)
+
+    def traverse():
+        norbert.traverse_subtags(tree, maxdepth=0)
+
+    # every grandchild of the root, like Entities#* in a chunk
+    query = norbert.compile_query("*/*")
+    matches = len(list(query.select(tree)))
+
+    def select():
+        for match in query.select(tree):
+            pass
+
+    # the tree's data, and the same with one leaf in the middle changed, like
+    # a world and its backup
+    def encode():
+        buf = io.BytesIO()
+        tree.write_file(buffer=buf)
+        return buf.getvalue()
+    old = encode()
+    (tag, value) = found[len(found) // 2]
+    norbert.set_tag(tag, "1")
+    new = encode()
+    norbert.set_tag(tag, value)
+
+    def diff_trees():
+        for triplet in diff.diff(old, new):
+            pass
+        return len(old)
+
+    def writer(compresslevel, threads):
+        outpath = os.path.join(tmpdir, "write.dat")
+        def write():
+            norbert.write_file(tree, outpath, compresslevel, threads)
+            return os.path.getsize(outpath)
+        return write
+
+    def formatter(format):
+        def print_tree():
+            f = CountingFile()
+            norbert.print_subtags(tree, maxdepth=0, format=format, out=f)
+            return f.size
+        return print_tree
+
+    cases = [
+        ("nbt_read_file",     read_nbt,     tags),
+        ("norbert_read_file", read_norbert, tags),
+        ("get_tag",           get_tags,     len(leaves)),
+        ("set_tag",           set_tags,     len(found)),
+        ("norbert_edit",      edit_tags,    len(leaves)),
+        ("traverse_subtags",  traverse,     tags),
+        ("Query.select",      select,       matches),
+        ("diff",              diff_trees,   tags),
+    ]
+    for (compresslevel, threads) in WRITES:
+        op = "write_file -z%d" % compresslevel
+        if threads != 1:
+            op += " -j%d" % threads
+        cases.append( (op, writer(compresslevel, threads), tags) )
+    for format in sorted(norbert.formatters):
+        cases.append( ("print " + format, formatter(format), tags) )
+    return cases
+
+# returns: a list of (operation, fn, None) benchmarks of starting python, and
+#          norbert, in a new process
+def startup_benchmarks():
+    # make sure norbert doesn't hand its arguments to a server
+    env = dict(os.environ)
+    env.pop("NORBERT_SOCKET", None)
+
+    def run(*args):
+        def start():
+            subprocess.check_call([sys.executable] + list(args), cwd=TOPDIR,
+                                  env=env, stdout=subprocess.DEVNULL)
+        return start
+
+    return [
+        ("python",            run("-c", "pass"),           None),
+        ("import norbert",    run("-c", "import norbert"), None),
+        ("norbert.py -h",     run("norbert.py", "-h"),     None),
+    ]
+
+# times fn, then runs it once more to measure its peak memory use
+#
+# returns: (fastest seconds, bytes returned by fn, peak bytes allocated)
+def measure(fn, repeat):
+    best = None
+    for i in range(repeat):
+        (seconds, size) = synth.timed(fn)
+        if best is None or seconds < best:
+            best = seconds
+
+    tracemalloc.start()
+    try:
+        fn()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return (best, size, peak)
+
+def main():
+    (options, shapes) = parse_args()
+    baseline = {}
+    if options.compare is not None:
+        with open(options.compare) as f:
+            baseline = json.load(f)
+
+    results = {}
+    regressions = 0
+    tmpdir = tempfile.mkdtemp()
+
+    print("%-9s %-18s %10s %12s %9s %9s %9s" % ("shape", "operation",
+                                                 "seconds", "tags/s", "MB/s",
+                                                 "peak MB", "vs base"))
+    try:
+        for shape in shapes:
+            if shape == "startup":
+                cases = startup_benchmarks()
+            else:
+                cases = benchmarks(SHAPES[shape](options.size), tmpdir)
+            for (op, fn, count) in cases:
+                (seconds, size, peak) = measure(fn, options.repeat)
+                key = shape + " " + op
+                results[key] = { "seconds": seconds, "peak": peak }
+
+                if count is not None and seconds > 0:
+                    rate = "%12.0f" % (count / seconds)
+                else:
+                    rate = "%12s" % "-"
+                if size is not None and seconds > 0:
+                    mbs = "%9.2f" % (size / seconds / 1e6)
+                else:
+                    mbs = "%9s" % "-"
+
+                change = "%9s" % "-"
+                if key in baseline:
+                    percent = (seconds / baseline[key]["seconds"] - 1) * 100
+                    change = "%+8.0f%%" % percent
+                    if percent > options.threshold:
+                        change += " REGRESSION"
+                        regressions += 1
+
+                print("%-9s %-18s %10.4f %s %s %9.2f %s" % (shape, op, seconds,
+                                                           rate, mbs,
+                                                           peak / 1e6, change))
+                sys.stdout.flush()
+    finally:
+        shutil.rmtree(tmpdir)
+
+    if options.save is not None:
+        with open(options.save, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+
+    if regressions != 0:
+        sys.stderr.write("%d benchmark(s) slower than the baseline\n" %
+                         regressions)
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,144 @@
+#
+#   synth.py - synthetic NBT trees for the norbert benchmarks
+#
+#   Copyright (C) 2012-2013 DMBuce <dmbuce@gmail.com>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with this program; if not, write to the Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import os
+import sys
+import time
+
+# make the norbert package in the source tree importable
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+from nbt import nbt
+import norbert
+
+# stands in for the options returned by norbert.parse_args()
+class Options(object):
+    def __init__(self, **kwargs):
+        self.infile = "level.dat"
+        self.outfile = None
+        self.format = norbert.DEFAULT_PRINTFORMAT
+        self.inputformat = norbert.DEFAULT_INPUTFORMAT
+        self.maxdepth = norbert.DEFAULT_MAXDEPTH
+        self.sep = norbert.DEFAULT_SEP
+        self.cachedir = None
+        self.window = None
+        self.query = False
+        self.editscript = None
+        self.difffile = None
+        self.__dict__.update(kwargs)
+
+# a TAG_List named "List" with n TAG_Compound children, each holding an id
+# and a position, similar to the Entities list of a chunk
+def long_list(n, name="Level"):
+    root = nbt.NBTFile()
+    root.name = name
+    entities = nbt.TAG_List(name="List", type=nbt.TAG_Compound)
+    for i in range(n):
+        entity = nbt.TAG_Compound()
+        entity.tags.append(nbt.TAG_String(name="id", value="Zombie"))
+        entity.tags.append(nbt.TAG_Int(name="n", value=i))
+        entities.tags.append(entity)
+    root.tags.append(entities)
+    return root
+
+# a TAG_Compound named "Compound" with n TAG_Int children, similar to a
+# scoreboard or stats file
+def wide_compound(n, name="Level"):
+    root = nbt.NBTFile()
+    root.name = name
+    compound = nbt.TAG_Compound(name="Compound")
+    for i in range(n):
+        compound.tags.append(nbt.TAG_Int(name="key" + str(i), value=i))
+    root.tags.append(compound)
+    return root
+
+# n levels of TAG_Compound's nested in each other, each holding a TAG_Int
+# and a TAG_String, like the deepest parts of some mod data. The nbt library
+# decodes nesting recursively, so n is capped at DEEP_MAX
+DEEP_MAX = 200
+
+def deep_compound(n, name="Level"):
+    root = nbt.NBTFile()
+    root.name = name
+    tag = root
+    for i in range(min(n, DEEP_MAX)):
+        child = nbt.TAG_Compound(name="Nested")
+        child.tags.append(nbt.TAG_Int(name="depth", value=i))
+        child.tags.append(nbt.TAG_String(name="id", value="level" + str(i)))
+        tag.tags.append(child)
+        tag = child
+    return root
+
+# a TAG_Byte_Array and a TAG_Int_Array of 64*n items each, like the blocks
+# and height map of a chunk
+def big_arrays(n, name="Level"):
+    root = nbt.NBTFile()
+    root.name = name
+    blocks = norbert.arrays.TAGLIST[nbt.TAG_BYTE_ARRAY](name="Blocks")
+    blocks.value = bytearray(i % 256 for i in range(64 * n))
+    heights = norbert.arrays.TAGLIST[nbt.TAG_INT_ARRAY](name="HeightMap")
+    heights.value = norbert.arrays.ints_from_ints(i - 32 * n
+                                                  for i in range(64 * n))
+    root.tags.extend([blocks, heights])
+    return root
+
+# a TAG_Compound named "Strings" with n TAG_String children full of
+# characters that norbert has to escape, like signs and books
+def escaped_strings(n, name="Level"):
+    root = nbt.NBTFile()
+    root.name = name
+    strings = nbt.TAG_Compound(name="Strings")
+    for i in range(n):
+        value = 'line %d\n\t"quoted" \\ caf\u00e9 \u2603 %d' % (i, i)
+        strings.tags.append(nbt.TAG_String(name="text" + str(i), value=value))
+    root.tags.append(strings)
+    return root
+
+# a TAG_List named "TileEntities" with n signs, each a TAG_Compound holding
+# four lines of plain text that norbert doesn't have to escape
+def sign_texts(n, name="Level"):
+    root = nbt.NBTFile()
+    root.name = name
+    signs = nbt.TAG_List(name="TileEntities", type=nbt.TAG_Compound)
+    for i in range(n):
+        sign = nbt.TAG_Compound()
+        sign.tags.append(nbt.TAG_String(name="id", value="Sign"))
+        for line in range(1, 5):
+            value = "sign %d says hello, line %d" % (i, line)
+            sign.tags.append(nbt.TAG_String(name="Text" + str(line),
+                                            value=value))
+        signs.tags.append(sign)
+    root.tags.append(signs)
+    return root
+
+# times a call to fn(*args), returning (seconds, return value)
+def timed(fn, *args, **kwargs):
+    start = time.time()
+    ret = fn(*args, **kwargs)
+    return (time.time() - start, ret)
+
+# counts the tags in a tree
+def count_tags(tag):
+    n = 1
+    if tag.id in (nbt.TAG_LIST, nbt.TAG_COMPOUND):
+        for child in tag.tags:
+            n += count_tags(child)
+    return n
@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+#
+#   traverse.py - benchmark traverse_subtags on long TAG_Lists
+#
+#   Copyright (C) 2012-2013 DMBuce <dmbuce@gmail.com>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with this program; if not, write to the Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import sys
+
+import synth
+import norbert
+
+SIZES = [ 1000, 10000, 100000 ]
+
+def main():
+    print("%10s %10s %10s %14s" % ("children", "tags", "seconds", "usec/tag"))
+    for n in SIZES:
+        root = synth.long_list(n)
+        tags = synth.count_tags(root)
+        seconds, ret = synth.timed(norbert.traverse_subtags, root, maxdepth=0)
+        print("%10d %10d %10.4f %14.3f" % (n, tags, seconds,
+                                           seconds * 1e6 / tags))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -19,8 +19,53 @@
 #   51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 #
 
-import norbert
+import os
 import sys
 
+# runs this invocation on the norbert --serve listening at path, without
+# importing norbert
+#
+# returns: the exit status, or None if no server is listening at path
+def run_on_server(path):
+    import socket
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        return None
+
+    request = b"".join( os.fsencode(field) + b'\0'
+                        for field in [os.getcwd()] + sys.argv[1:] )
+    sys.stdout.flush()
+    sys.stderr.flush()
+    try:
+        socket.send_fds(sock, [b'\0'], [0, 1, 2])
+        sock.sendall(request)
+        sock.shutdown(socket.SHUT_WR)
+        status = b""
+        while True:
+            data = sock.recv(64)
+            if data == b"":
+                break
+            status += data
+    except OSError as e:
+        sys.stderr.write("norbert server: %s\n" % e.strerror)
+        return 1
+    finally:
+        sock.close()
+
+    try:
+        return int(status)
+    except ValueError:
+        sys.stderr.write("norbert server: no exit status\n")
+        return 1
+
+if os.environ.get("NORBERT_SOCKET"):
+    status = run_on_server(os.environ["NORBERT_SOCKET"])
+    if status is not None:
+        sys.exit(status)
+
+import norbert
 sys.exit(norbert.main())
 
@@ -19,19 +19,37 @@
 #   51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 #
 
-__all__ = [ "exceptions" ]
-from . import *
-
-import optparse
+__all__ = [ "arrays", "compress", "diff", "diskcache", "exceptions", "lazy",
+            "patch", "region", "server", "stats", "stream" ]
+# the other modules are only imported by the code that needs them, to keep
+# startup fast
+from . import exceptions
+
+import io
+import os
 import sys
 from nbt import nbt
-import codecs
 
 VERSION = "0.5"
 DEFAULT_MAXDEPTH = 8
 DEFAULT_PRINTFORMAT = "human"
 DEFAULT_INPUTFORMAT = "nbt"
 DEFAULT_SEP = "/#="
+DEFAULT_BUFSIZE = 65536
+DEFAULT_COMPRESSLEVEL = 9
+DEFAULT_CACHESIZE = 1024
+
+# TAG_Compound's with fewer children than this are searched without an index
+INDEX_MIN_TAGS = 8
+
+# names and queries kept parsed by compile_path() and compile_query()
+COMPILED_PATHS = 4096
+COMPILED_QUERIES = 256
+
+# norbert files with fewer lines than this are parsed in a single process
+NORBERT_PARALLEL_LINES = 100000
+# lines parsed at a time by each process
+NORBERT_CHUNK_LINES = 4096
 
 formatters = {}
 readers = {}
@@ -70,6 +88,7 @@ complex_tag_types = [
 ]
 
 def parse_args():
+    import optparse
     usage = "%prog [options] [tag] [tag2] [tag3] ..." #TODO: man page
     desc  = "Edits or displays an NBT file. " \
             "<tag>s are given in norbert(5) format, with the tag type and value " \
@@ -95,15 +114,18 @@ def parse_args():
                       dest="format",
                       default=DEFAULT_PRINTFORMAT,
                       help="Format to print output in. " \
-                           "Valid values are \"human\", \"nbt-txt\" " \
-                           "and \"norbert\". " \
-                           "Default is \"" + DEFAULT_PRINTFORMAT + "\".") #TODO: add "nbt", "json"
+                           "Valid values are \"human\", \"nbt-txt\", " \
+                           "\"norbert\", \"nbt\", \"json\" and " \
+                           "\"ndjson\". " \
+                           "Default is \"" + DEFAULT_PRINTFORMAT + "\".")
     parser.add_option("-i", "--input-format",
                       dest="inputformat",
                       default=DEFAULT_INPUTFORMAT,
                       help="Format of the input file. " \
-                           "Valid values are \"nbt\" and \"norbert\". " \
-                           "Default is \"" + DEFAULT_INPUTFORMAT + "\".") #TODO: add "json"
+                           "Valid values are \"nbt\", \"nbt-lazy\", " \
+                           "\"nbt-stream\", \"norbert\", \"json\" and " \
+                           "\"region\". " \
+                           "Default is \"" + DEFAULT_INPUTFORMAT + "\".")
     parser.add_option("-d", "--depth",
                       dest="maxdepth",
                       type="int",
@@ -122,12 +144,133 @@ def parse_args():
                            "delimit list indices, and the third character is used to " \
                            "separate names and values. Default is '" + DEFAULT_SEP + \
                            "'")
+    parser.add_option("-q", "--query",
+                      dest="query",
+                      action="store_true",
+                      default=False,
+                      help="Treat the <tag> arguments as queries, names " \
+                           "with wildcards and predicates that can match " \
+                           "many tags, e.g. Entities#*[id=Zombie]. Every " \
+                           "tag that matches is printed, or set if a " \
+                           "value is given. See norbert(1), section " \
+                           "'Queries'.")
+    parser.add_option("-P", "--patch",
+                      dest="patchfile",
+                      default=None,
+                      help="Apply PATCHFILE, a unified diff between two " \
+                           "dumps of the input file made with " \
+                           "-d 0 -p norbert, before the <tag> arguments. " \
+                           "Only the tags on changed lines are modified. " \
+                           "With this option, nothing is printed unless " \
+                           "<tag>s are given.")
+    parser.add_option("-e", "--edit-script",
+                      dest="editscript",
+                      default=None,
+                      help="Set the tags in EDITSCRIPT, a file of " \
+                           "<name>=<value> lines like the <tag> " \
+                           "arguments, before the <tag> arguments. Use - " \
+                           "to read it from stdin. Nothing is set unless " \
+                           "every line can be. With this option, nothing " \
+                           "is printed unless <tag>s are given.")
+    parser.add_option("-D", "--diff",
+                      dest="difffile",
+                      default=None,
+                      help="Print the tags that differ between the input " \
+                           "file and DIFFFILE, in norbert format, instead " \
+                           "of printing any <tag>s. Tags only in the " \
+                           "input file are printed with a leading -, and " \
+                           "tags only in DIFFFILE with a leading +. A " \
+                           "tag that changed is printed both ways.")
+    parser.add_option("-C", "--cache-dir",
+                      dest="cachedir",
+                      default=None,
+                      help="Keep decompressed, indexed copies of NBT files " \
+                           "in CACHEDIR, so that later lookups in the same " \
+                           "file can go straight to the tags they want. " \
+                           "Used with -i nbt-stream, and with -i nbt " \
+                           "if -o isn't given.")
+    parser.add_option("--cache-size",
+                      dest="cachesize",
+                      type="int",
+                      default=DEFAULT_CACHESIZE,
+                      help="Set the maximum size of the cache in MB. The " \
+                           "least recently used files are removed from " \
+                           "the cache to stay under it. Default is " + \
+                           str(DEFAULT_CACHESIZE) + ".")
+    parser.add_option("-w", "--window",
+                      dest="window",
+                      type="int",
+                      default=None,
+                      help="Decode the elements of long TAG_List's at most " \
+                           "WINDOW at a time, letting go of each window " \
+                           "before decoding the next, so that memory use " \
+                           "doesn't grow with the length of the list. " \
+                           "Used with -i nbt and -i nbt-lazy.")
+    parser.add_option("-b", "--batch",
+                      dest="manifest",
+                      default=None,
+                      help="Apply the <tag> arguments to each file listed " \
+                           "in MANIFEST instead of the file given by -f. " \
+                           "Use - to read the list from stdin. Each line " \
+                           "of MANIFEST is a file to read, optionally " \
+                           "followed by a tab and a file to write it to.")
+    parser.add_option("-j", "--jobs",
+                      dest="jobs",
+                      type="int",
+                      default=0,
+                      help="Number of processes to use for files with many " \
+                           "NBT trees, such as region files, for " \
+                           "batches of files, and for parsing large " \
+                           "norbert files, and of threads to compress " \
+                           "files written with -o. Use 0 for one per " \
+                           "CPU. Default is 0.")
+    parser.add_option("-z", "--compress-level",
+                      dest="compresslevel",
+                      type="int",
+                      default=DEFAULT_COMPRESSLEVEL,
+                      help="Set the gzip compression level of files " \
+                           "written with -o and of binary NBT output, " \
+                           "from 1 (fastest) to 9 (smallest). Use 0 for " \
+                           "no compression. Default is " + \
+                           str(DEFAULT_COMPRESSLEVEL) + ".")
+    parser.add_option("--stats",
+                      dest="stats",
+                      action="store_true",
+                      default=False,
+                      help="When done, print the time spent in each phase " \
+                           "of the run, the number of tags visited and " \
+                           "lines printed, the bytes read and written, " \
+                           "and the peak memory use to stderr.")
+    parser.add_option("--stats-file",
+                      dest="statsfile",
+                      default=None,
+                      help="Like --stats, but write the stats to " \
+                           "STATSFILE as JSON.")
+    parser.add_option("--profile",
+                      dest="profile",
+                      action="store_true",
+                      default=False,
+                      help="Like --stats, and also time the formatter " \
+                           "for each tag printed, by tag type. Slows " \
+                           "down printing.")
+    parser.add_option("--serve",
+                      dest="serversocket",
+                      default=None,
+                      help="Listen for norbert invocations on the UNIX " \
+                           "socket SERVERSOCKET instead of editing a " \
+                           "file. norbert runs its arguments on the " \
+                           "server when NORBERT_SOCKET is set to the " \
+                           "socket, which saves starting up each time.")
     #parser.add_option("-c", "--create",
 
     (options, args) = parser.parse_args()
 
+    if options.statsfile is not None or options.profile:
+        options.stats = True
+
     # if no tags are given, print starting from the top-level tag
-    if len(args) == 0:
+    if len(args) == 0 and options.patchfile is None and \
+       options.editscript is None and options.difffile is None:
         args.append("")
 
     if len(options.sep) == 0 or len(options.sep) > len(DEFAULT_SEP):
@@ -138,7 +281,6 @@ def parse_args():
         )
     else:
         options.sep += DEFAULT_SEP[ len(options.sep) : len(DEFAULT_SEP) ]
-        norbert_print_pre.sep = options.sep
 
     # validate input format
     if options.format not in formatters:
@@ -148,14 +290,157 @@ def parse_args():
             options.format
         )
 
+    if options.compresslevel < 0 or options.compresslevel > 9:
+        raise exceptions.InvalidOptionError(
+            "-z",
+            "Must be between 0 and 9",
+            str(options.compresslevel)
+        )
+    else:
+        BinaryWriter.compresslevel = options.compresslevel
+
+    # lossless formats always print the whole tag
+    if options.format in ["nbt", "json", "ndjson"]:
+        options.maxdepth = 0
+
+    # binary output can't be mixed with text
+    if options.format == "nbt":
+        if options.manifest is not None or options.inputformat == "region":
+            raise exceptions.InvalidOptionError(
+                "-p",
+                "Can't print nbt with -b or -i region"
+            )
+
+    if options.window is not None:
+        if options.window < 1:
+            raise exceptions.InvalidOptionError(
+                "-w",
+                "Must be at least 1",
+                str(options.window)
+            )
+        elif options.inputformat not in ["nbt", "nbt-lazy"]:
+            raise exceptions.InvalidOptionError(
+                "-w",
+                "Can only be used with -i nbt or -i nbt-lazy"
+            )
+
+    if options.cachesize < 0:
+        raise exceptions.InvalidOptionError(
+            "--cache-size",
+            "Must not be negative",
+            str(options.cachesize)
+        )
+
+    if options.jobs < 0:
+        raise exceptions.InvalidOptionError(
+            "-j",
+            "Must not be negative",
+            str(options.jobs)
+        )
+    elif options.jobs == 0:
+        options.jobs = os.cpu_count() or 1
+
+    if options.manifest is not None:
+        if options.outfile is not None:
+            raise exceptions.InvalidOptionError(
+                "-o",
+                "Can't be used with -b, give output files in the manifest"
+            )
+        elif options.inputformat == "region":
+            raise exceptions.InvalidOptionError(
+                "-b",
+                "Can't be used with -i region"
+            )
+
+    if options.inputformat == "nbt-stream" and options.outfile is not None:
+        raise exceptions.InvalidOptionError(
+            "-o",
+            "Can't write files read with -i nbt-stream"
+        )
+
+    if options.difffile is not None:
+        if len(args) != 0:
+            raise exceptions.InvalidOptionError(
+                "-D",
+                "Can't be used with <tag> arguments"
+            )
+        elif options.outfile is not None or options.patchfile is not None \
+             or options.editscript is not None or \
+             options.manifest is not None or options.query:
+            raise exceptions.InvalidOptionError(
+                "-D",
+                "Can't be used with -o, -P, -e, -b or -q"
+            )
+        elif options.inputformat not in readers and \
+             options.inputformat != "region":
+            raise exceptions.InvalidOptionError(
+                "-i",
+                "Unknown format",
+                options.inputformat
+            )
+
+    if options.patchfile is not None and \
+       (options.manifest is not None or
+        options.inputformat in ["nbt-stream", "region"]):
+        raise exceptions.InvalidOptionError(
+            "-P",
+            "Can't be used with -b, -i nbt-stream or -i region"
+        )
+
+    if options.editscript is not None and \
+       (options.manifest is not None or
+        options.inputformat in ["nbt-stream", "region"]):
+        raise exceptions.InvalidOptionError(
+            "-e",
+            "Can't be used with -b, -i nbt-stream or -i region"
+        )
+
     return (options, args)
 
 def main():
     try:
         # parse and validate arguments
         (options, args) = parse_args()
+    except exceptions.InvalidOptionError as e:
+        err(e.strerror)
+        return e.errno
+
+    if options.serversocket is not None:
+        from . import server
+        try:
+            return server.serve(options.serversocket)
+        except IOError as e:
+            err(e.strerror)
+            return e.errno
+
+    if not options.stats:
+        return norbert_main(options, args)
+
+    global runstats
+    from . import stats
+    runstats = stats.Stats()
+    runstats.enable(profile=options.profile)
+    try:
+        retval = norbert_main(options, args)
+    finally:
+        output.flush()
+        r = write_stats(options)
+    return retval or r
+
+def norbert_main(options, args):
+    try:
+        # diffs are printed as the files are compared
+        if options.difffile is not None:
+            return norbert_diff(options)
+        # batches of files are handled a file at a time
+        if options.manifest is not None:
+            return norbert_batch(options, args)
+        # region files are handled a chunk at a time
+        if options.inputformat == "region":
+            return norbert_region(options, args)
         # open file
-        nbtfile = read_file(options, args)
+        with runstats.phase("read"):
+            nbtfile = read_file(options, args)
     except exceptions.InvalidOptionError as e:
         err(e.strerror)
         return e.errno
@@ -163,19 +448,46 @@ def main():
         err(e.strerror)
         return e.errno
 
-    # read and/or set tags
-    retval = 0
-    for arg in args:
-        r = norbert(nbtfile, options, arg)
-        if r > retval:
-            retval = r
+    # apply the patch, if any
+    if options.patchfile is not None:
+        with runstats.phase("patch"):
+            retval = norbert_patch(nbtfile, options)
+        if retval != 0:
+            return retval
+
+    # apply the edit script, if any
+    if options.editscript is not None:
+        with runstats.phase("edit"):
+            retval = norbert_edit(nbtfile, options)
+        if retval != 0:
+            return retval
 
+    # read and/or set tags
+    retval = norbert_args(nbtfile, options, args)
     if retval != 0:
         return retval
 
     # write file if necessary
     if options.outfile is not None:
-            nbtfile.write_file(options.outfile)
+        with runstats.phase("write"):
+            return norbert_write(nbtfile, options, threads=options.jobs)
+
+    return 0
+
+# writes the stats recorded in runstats to options.statsfile, or stderr
+#
+# returns: an exit status
+def write_stats(options):
+    if options.statsfile is None:
+        runstats.report(sys.stderr)
+        return 0
+
+    try:
+        with open(options.statsfile, 'w') as f:
+            runstats.dump(f)
+    except IOError as e:
+        err(file_error(e, options.statsfile).strerror)
+        return e.errno
 
     return 0
 
@@ -188,40 +500,251 @@ def read_file(options, args):
             err("Input format not recognized: " + options.inputformat)
             return None
     except IOError as e:
-        # make sure error has strerror, errno
-        if e.strerror is None:
-            e.strerror = str(e)
+        raise file_error(e, options.infile)
 
-        if options.infile not in e.strerror:
-            e.strerror += ": '" + options.infile + "'"
+    if runstats.enabled and os.path.isfile(options.infile):
+        runstats.count("bytes read", os.path.getsize(options.infile))
 
-        if e.errno is None or e.errno == 0:
-            e.errno = exceptions.GENERAL_ERROR
+    return nbtfile
 
-        raise e
+# makes sure an IOError has strerror and errno, and that strerror names the
+# file it happened to
+def file_error(e, filename):
+    if e.strerror is None:
+        e.strerror = str(e)
 
-    return nbtfile
+    if filename not in e.strerror:
+        e.strerror += ": '" + filename + "'"
+
+    if e.errno is None or e.errno == 0:
+        e.errno = exceptions.GENERAL_ERROR
+
+    return e
 
 def nbt_read_file(options):
-    return nbt.NBTFile(options.infile)
+    # files that won't be written can be read from the cache
+    if options.cachedir is not None and \
+       options.outfile is None:
+        return nbt_stream_read_file(options)
+    # long lists are only decoded a window at a time by the lazy reader
+    if options.window is not None:
+        return nbt_lazy_read_file(options)
+
+    from . import arrays, stream
+    # decompressing the whole file before parsing it is faster than parsing
+    # from a GzipFile, and lets the two be timed separately. Files written
+    # with -z 0 aren't compressed at all
+    with runstats.phase("decompress"):
+        with stream.open_file(options.infile) as f:
+            data = f.read()
+    runstats.count("bytes decompressed", len(data))
+
+    with runstats.phase("parse"):
+        try:
+            nbtfile = arrays.NBTFile(buffer=io.BytesIO(data))
+        except nbt.MalformedFileError as e:
+            raise IOError("Corrupt NBT data: " + str(e))
+    nbtfile.filename = options.infile
+    return nbtfile
+
 readers["nbt"] = nbt_read_file
 
+# reads an NBT file without decoding the contents of TAG_Compound's and
+# TAG_List's until they are accessed
+#
+# If options.window is set, TAG_List's longer than it are decoded that many
+# elements at a time.
+def nbt_lazy_read_file(options):
+    from . import lazy
+    lazy.LazyList.window = options.window
+    return lazy.read_file(options.infile)
+
+readers["nbt-lazy"] = nbt_lazy_read_file
+
+# opens an NBT file without reading it. Each call to get_tag() reads only as
+# much of the file as it needs to find its tag
+#
+# If options.cachedir is set, the file is looked up in the cache instead.
+def nbt_stream_read_file(options):
+    if options.cachedir is not None:
+        from . import diskcache
+        cache = diskcache.Cache(options.cachedir,
+                                options.cachesize * 1024 * 1024)
+        return cache.open(options.infile)
+
+    from . import stream
+    # open the file once to make sure it exists and can be read
+    stream.open_file(options.infile).close()
+    return stream.NBTStream(options.infile)
+
+readers["nbt-stream"] = nbt_stream_read_file
+
+# reads a norbert file in two stages
+#
+# First, lines are parsed into (names, type, value) triplets, which doesn't
+# depend on any other line. Files of NORBERT_PARALLEL_LINES lines or more are
+# split into chunks of NORBERT_CHUNK_LINES lines that are parsed by a pool of
+# options.jobs processes. Then the triplets are made into tags and added to
+# the tree in this process, in the order of the lines they came from.
 def norbert_read_file(options):
-    nbtfile = nbt.NBTFile()
     with open(options.infile) as f:
         try:
-            for line in f:
-                # parse names/indexes, type, value of tag
-                names, tag = norbert_parse_line(line, options.sep)
-                # add tag to nbtfile
-                norbert_add_tag(nbtfile, names, tag)
-        except UnicodeDecodeError as e:
+            lines = f.readlines()
+        except UnicodeDecodeError:
             raise IOError("Not a norbert file")
 
+    if len(lines) < NORBERT_PARALLEL_LINES:
+        chunks = [ lines ]
+    else:
+        chunks = [ lines[i : i + NORBERT_CHUNK_LINES]
+                   for i in range(0, len(lines), NORBERT_CHUNK_LINES) ]
+    del lines
+    share = getattr(options, "jobs", 1) != 1 and len(chunks) != 1
+    jobs = [ (chunk, options.sep, share) for chunk in chunks ]
+    del chunks
+
+    nbtfile = nbt.NBTFile()
+    index = {}
+    results = map_jobs(options, norbert_scan_chunk, jobs)
+    try:
+        for ((scanned, errno), errors) in results:
+            if scanned is None:
+                sys.stderr.write(errors)
+                raise IOError(errno, "Not a norbert file")
+            for (names, tagtype, value) in scanned:
+                norbert_add_tag(nbtfile, names,
+                                norbert_new_tag(tagtype, value), index)
+    finally:
+        # stops the jobs that are left if a chunk isn't valid
+        results.close()
+
     return nbtfile
 
 readers["norbert"] = norbert_read_file
 
+# reads a tag printed by the json formatter
+#
+# Tags are built by json_object() as the parser finishes each JSON object,
+# so the file is never held as a tree of dicts and lists as well.
+def json_read_file(options):
+    import json
+    try:
+        with io.open(options.infile, encoding="utf-8") as f:
+            root = json.load(f, object_pairs_hook=json_object)
+    except UnicodeDecodeError:
+        raise IOError("Not a JSON file")
+    except ValueError as e:
+        raise IOError("Invalid JSON: " + str(e))
+
+    if not isinstance(root, nbt.TAG) or root.id != nbt.TAG_COMPOUND:
+        raise IOError("Invalid JSON: root tag is not a TAG_Compound")
+
+    nbtfile = nbt.NBTFile()
+    nbtfile.name = root.name or ""
+    nbtfile.tags = root.tags
+    return nbtfile
+
+readers["json"] = json_read_file
+
+# converts the (key, value) pairs of a JSON object into a tag, or into the
+# children of a TAG_Compound if every value is already a tag
+#
+# raises: ValueError if the object isn't a tag
+def json_object(pairs):
+    if all(isinstance(value, nbt.TAG) for key, value in pairs):
+        return pairs
+
+    fields = dict(pairs)
+    tagtype = fields.get("type")
+    if not isinstance(tagtype, str) or tagtype not in tag_types \
+       or "value" not in fields:
+        import json
+        raise ValueError("not a tag: " + json.dumps(fields)[:80])
+
+    tagid = tag_types[tagtype]
+    value = fields["value"]
+    if tagid == nbt.TAG_COMPOUND and isinstance(value, list):
+        tag = nbt.TAG_Compound()
+        for name, child in value:
+            child.name = name
+            tag.tags.append(child)
+    elif tagid == nbt.TAG_LIST and isinstance(value, list):
+        tagid = tag_types.get(fields.get("tagType"))
+        if not isinstance(tagid, int) or \
+           any(child.id != tagid for child in value):
+            raise ValueError("bad TAG_List type: " + str(fields.get("tagType")))
+        tag = nbt.TAG_List(type=nbt.TAGLIST[tagid])
+        tag.tags = value
+    elif tagid in [nbt.TAG_BYTE_ARRAY, nbt.TAG_INT_ARRAY] and \
+         isinstance(value, list) and \
+         all(isinstance(i, int) for i in value):
+        from . import arrays
+        tag = arrays.TAGLIST[tagid]()
+        if tagid == nbt.TAG_BYTE_ARRAY:
+            tag.value = arrays.bytes_from_ints(value)
+        else:
+            tag.value = arrays.ints_from_ints(value)
+    elif tagid in json_types and isinstance(value, json_types[tagid]):
+        tag = nbt.TAGLIST[tagid]()
+        tag.value = value
+    elif tagid in [nbt.TAG_FLOAT, nbt.TAG_DOUBLE] and \
+         isinstance(value, str) and value in json_nonfinite:
+        tag = nbt.TAGLIST[tagid]()
+        tag.value = json_nonfinite[value]
+    else:
+        import json
+        raise ValueError("bad %s value: %s" % (tagtype, json.dumps(value)[:80]))
+
+    tag.name = fields.get("name")
+    return tag
+
+# the JSON types of the values of tags that have no children
+json_types = {
+    nbt.TAG_BYTE:   int,
+    nbt.TAG_SHORT:  int,
+    nbt.TAG_INT:    int,
+    nbt.TAG_LONG:   int,
+    nbt.TAG_FLOAT:  (int, float),
+    nbt.TAG_DOUBLE: (int, float),
+    nbt.TAG_STRING: str
+}
+
+# the strings that the values of TAG_Float's and TAG_Double's that aren't
+# finite are written as, since JSON has no numbers for them
+json_nonfinite = {
+    "NaN":       float("nan"),
+    "Infinity":  float("inf"),
+    "-Infinity": float("-inf")
+}
+
+# parses a chunk of norbert-formatted lines with norbert_scan_line()
+#
+# job is a (lines, sep, share) triplet of arguments to norbert_scan_lines().
+#
+# returns: ((list of (names, type, value) triplets, 0), messages), or
+#          ((None, errno), messages) if a line couldn't be parsed
+def norbert_scan_chunk(job):
+    (lines, sep, share) = job
+    return capture_errors(norbert_scan_lines, lines, sep, share)
+
+# If share is True, equal names are made the same object, so they are
+# pickled only once when the triplets are sent from a pool process.
+def norbert_scan_lines(lines, sep, share=False):
+    try:
+        scanned = [ norbert_scan_line(line, sep) for line in lines ]
+    except IOError as e:
+        return (None, e.errno)
+
+    if not share:
+        return (scanned, 0)
+
+    seen = {}
+    for (names, tagtype, value) in scanned:
+        for i, name in enumerate(names):
+            names[i] = seen.setdefault(name, name)
+
+    return (scanned, 0)
+
 # parses a norbert-formatted line, e.g.
 #
 #     norbert_parse_line("asdf.jkl#1#2 = (TAG_Short) 237")
@@ -231,8 +754,33 @@ readers["norbert"] = norbert_read_file
 #     (["asdf", "jkl", 1, 2], nbt.Tag_Short(237))
 #
 def norbert_parse_line(line, sep=DEFAULT_SEP):
+    names, tagtype, value = norbert_scan_line(line, sep)
+    return names, norbert_new_tag(tagtype, value)
+
+# parses a norbert-formatted line like norbert_parse_line(), but returns
+# the tag's type and value instead of a tag
+#
+# For TAG_List's, the value is the type of the list's elements, and for
+# TAG_Compound's it is None. Lines with no escapes in their value, like the
+# ones norbert prints, are split with str.partition(). Other lines are split
+# by norbert_split_line().
+def norbert_scan_line(line, sep=DEFAULT_SEP):
     line = line.strip()
-    name, tagtype, value = norbert_split_line(line, sep[2])
+    name, found, rest = line.partition(sep[2])
+    rest = rest.lstrip()
+    tagtype = None
+    if rest.startswith('(TAG_'):
+        typename, found, value = rest.partition(')')
+        tagtype = tag_types.get(typename[1:])
+        value = value.lstrip()
+    if tagtype is None or '\\' in value or not value.isascii():
+        name, tagtype, value = norbert_split_line(line, sep[2])
+    elif tagtype != nbt.TAG_COMPOUND and (value != "" or
+                                          tagtype == nbt.TAG_STRING):
+        name = name.strip()
+    else:
+        name = name.strip()
+        value = None
 
     # validate user input
     if tagtype is None:
@@ -243,22 +791,41 @@ def norbert_parse_line(line, sep=DEFAULT_SEP):
         raise IOError(exceptions.INVALID_VALUE, "Not a norbert file")
 
     # get the list of names/indexes
-    names = norbert_split_name(name, sep)
+    if sep[1] in name:
+        names = norbert_split_name(name, sep)
+    else:
+        names = name.split(sep[0])
+
+    # convert the value
+    try:
+        if tagtype == nbt.TAG_LIST:
+            value = tag_types[value]
+        elif tagtype == nbt.TAG_COMPOUND:
+            value = None
+        else:
+            value = value_parsers[tagtype](value)
+    except (KeyError, ValueError):
+        err("Couldn't convert " + value + " to " + tag_types[tagtype] + '.')
+        err("Invalid tag value: " + line)
+        raise IOError(exceptions.TAG_CONVERSION_ERROR, "Not a norbert file")
 
-    # create the tag
+    return names, tagtype, value
+
+# returns: a new tag of type tagtype, with a value returned by
+#          norbert_scan_line()
+def norbert_new_tag(tagtype, value):
     if tagtype == nbt.TAG_LIST:
-        listtype = tag_types[value]
-        tag = nbt.TAG_List(type=nbt.TAGLIST[listtype])
+        return nbt.TAG_List(type=nbt.TAGLIST[value])
     elif tagtype == nbt.TAG_COMPOUND:
-        tag = nbt.TAG_Compound()
+        return nbt.TAG_Compound()
+    elif tagtype == nbt.TAG_INT_ARRAY:
+        from . import arrays
+        tag = arrays.TAG_Int_Array()
     else:
         tag = nbt.TAGLIST[tagtype]()
-        retval = set_tag(tag, value)
-        if retval != 0:
-            err("Invalid tag value: " + line)
-            raise IOError(retval, "Not a norbert file")
 
-    return names, tag
+    tag.value = value
+    return tag
 
 # splits a norbert line into its name, type, and value
 #
@@ -304,13 +871,32 @@ def norbert_split_line(nametypevaluetriplet, sep):
     try:
         if tagtype == nbt.TAG_STRING \
           or ( tagtype != nbt.TAG_COMPOUND and nametypevalue != "" ):
-            value = codecs.getdecoder("unicode_escape")(nametypevalue)[0]
+            value = norbert_unescape(nametypevalue)
         # else value is None
     except:
         value = None
 
     return (name, tagtype, value)
 
+# returns: a value with backslashes, and characters that aren't printable
+#          ASCII, escaped as in a Python string literal
+#
+# Values with nothing to escape, like numbers and most names, are returned
+# as they are.
+def norbert_escape(value):
+    if value.isascii() and value.isprintable() and '\\' not in value:
+        return value
+    return value.encode("unicode_escape").decode("utf-8")
+
+# returns: a value with the escapes made by norbert_escape() decoded
+#
+# Values with no backslashes in them are returned as they are if they're
+# ASCII, since there's nothing to decode.
+def norbert_unescape(value):
+    if value.isascii() and '\\' not in value:
+        return value
+    return value.encode("utf-8").decode("unicode_escape")
+
 # splits a full norbert name into its component names and indexes
 #
 # example:
@@ -320,30 +906,60 @@ def norbert_split_line(nametypevaluetriplet, sep):
 def norbert_split_name(name, sep=DEFAULT_SEP):
     names = []
     for n in name.split(sep[0]):
-        n, indexes = split_name(n, sep[1])
-        names.append(n)
-        for i in indexes:
-            names.append(int(i))
+        if sep[1] in n:
+            indexes = n.split(sep[1])
+            names.append(indexes[0])
+            names.extend(map(int, indexes[1:]))
+        else:
+            names.append(n)
 
     return names
 
 # inserts a tag into an nbtfile, creating new TAG_List's and TAG_Compound's as
 # necessary
 #
-def norbert_add_tag(nbtfile, names, newtag):
+# index is an optional dict that maps (id(parent), name) pairs to the tags
+# that were added to nbtfile. Passing the same index on every call lets each
+# name be looked up in constant time instead of scanning parent.tags, which
+# makes building a tree from n lines O(n) instead of O(n^2). If index is
+# given, it must be the only way tags are added to nbtfile.
+#
+# The index also maps None to the names of the parent of the last tag added
+# and the parent itself. Lines that add siblings are usually next to each
+# other, so those names are compared first to skip looking up the parent.
+#
+def norbert_add_tag(nbtfile, names, newtag, index=None):
     # give the root TAG_Compound the right name
     nbtfile.name = names[0]
     names.pop(0)
 
     tag = nbtfile
-    for i, name in enumerate(names):
-        testtag = get_tag(tag, str(name))
+    start = 0
+    if index is not None and len(names) != 0:
+        parentnames = names[:-1]
+        last = index.get(None)
+        if last is not None and last[0] == parentnames:
+            tag = last[1]
+            start = len(names) - 1
+
+    for i in range(start, len(names)):
+        name = names[i]
+        if index is not None and i+1 == len(names):
+            index[None] = (parentnames, tag)
+
+        if index is None:
+            testtag = get_tag(tag, str(name))
+        else:
+            key = (id(tag), name)
+            testtag = index.get(key)
+
         # tag already exists
         if testtag is not None:
             tag = testtag
+            continue
 
         # add leaf node
-        elif i+1 == len(names):
+        if i+1 == len(names):
             tag = norbert_add_child(tag, name, newtag)
 
         # add a list
@@ -366,6 +982,9 @@ def norbert_add_tag(nbtfile, names, newtag):
         else:
             tag = norbert_add_child(tag, name, nbt.TAG_Compound())
 
+        if index is not None:
+            index[key] = tag
+
 def norbert_add_child(tag, i, child):
     # insert child into list
     if tag.id == nbt.TAG_LIST:
@@ -375,54 +994,1335 @@ def norbert_add_child(tag, i, child):
         child.name = i
         tag.tags.append(child)
 
+        # keep the index up to date, if there is one
+        index = getattr(tag, "nameindex", None)
+        if index is not None and index[0] == len(tag.tags) - 1:
+            index[0] += 1
+            index[1].setdefault(i, len(tag.tags) - 1)
+
     return child
 
-def norbert(nbtfile, options, arg):
+# applies options.patchfile, a unified diff between two norbert dumps of
+# nbtfile, to nbtfile
+#
+# Lines are matched up by name, so only the changed lines are parsed and only
+# their tags are touched. A name that is both removed and added has its tag
+# replaced, or just its value set if the type didn't change. A removed name
+# has its tag deleted, along with any ancestors that are left empty. Then the
+# added names are inserted, like the lines of a norbert file. Nothing is
+# changed unless every line parses and every removed tag is in nbtfile with
+# the right type.
+#
+# returns: 0, or an error code
+def norbert_patch(nbtfile, options):
+    from . import patch
+    try:
+        with open(options.patchfile) as f:
+            (removed, added) = patch.read_diff(f)
+        removed = [ norbert_scan_line(line, options.sep) for line in removed ]
+        added = [ norbert_scan_line(line, options.sep) for line in added ]
+    except IOError as e:
+        e = file_error(e, options.patchfile)
+        err(e.strerror)
+        return e.errno
+
+    # find the removed tags before anything moves
+    #
+    # found maps the names of each removed tag to (ancestors, tag), where
+    # ancestors are the tags on the way to it, starting with nbtfile
+    found = {}
+    for (names, tagtype, value) in removed:
+        ancestors = norbert_find_ancestors(nbtfile, names)
+        tag = None
+        if ancestors is not None:
+            tag = ancestors.pop()
+        if tag is None or len(ancestors) == 0:
+            err("Patch doesn't apply, tag not found: " + norbert_join_name(
+                names, options.sep))
+            return exceptions.TAG_NOT_FOUND
+        elif tag.id != tagtype:
+            err("Patch doesn't apply, %s is not a %s" % (
+                norbert_join_name(names, options.sep), tag_types[tagtype]))
+            return exceptions.INVALID_TYPE
+        found[tuple(names)] = (ancestors, tag)
+
+    # replace or set changed tags
+    inserted = []
+    for (names, tagtype, value) in added:
+        key = tuple(names)
+        if key not in found:
+            inserted.append( (names, tagtype, value) )
+            continue
+
+        (ancestors, tag) = found.pop(key)
+        if tag.id == tagtype and tagtype not in complex_tag_types:
+            tag.value = value
+        else:
+            newtag = norbert_new_tag(tagtype, value)
+            newtag.name = tag.name
+            parent = ancestors[-1]
+            parent.tags[norbert_position(parent, tag)] = newtag
+
+    # delete removed tags, and any ancestors left empty, a parent at a time
+    while len(found) != 0:
+        parents = {}
+        for (ancestors, tag) in found.values():
+            parent = ancestors[-1]
+            if id(parent) not in parents:
+                parents[id(parent)] = (ancestors, set())
+            parents[id(parent)][1].add(id(tag))
+
+        found = {}
+        for (ancestors, doomed) in parents.values():
+            parent = ancestors[-1]
+            parent.tags = [ child for child in parent.tags
+                            if id(child) not in doomed ]
+            if len(parent.tags) == 0 and len(ancestors) > 1:
+                found[id(parent)] = (ancestors[:-1], parent)
+
+    for (names, tagtype, value) in inserted:
+        norbert_add_tag(nbtfile, names, norbert_new_tag(tagtype, value))
+
+    return 0
+
+# sets the tags named in options.editscript, a file of <name>=<value> lines
+#
+# Every line is checked before anything is set: each tag must exist and its
+# value must convert to the tag's type, or nothing is set and every line in
+# error is reported. Names are split like those of a norbert file and sorted,
+# so that names sharing a prefix are next to each other, and the tags on the
+# way to the last one found are kept by depth, so each tag on the way to
+# those being set is only looked up once. Lines that set the same tag are
+# applied in order.
+#
+# returns: an exit status
+def norbert_edit(nbtfile, options):
+    if options.editscript == "-":
+        scriptname = "stdin"
+    else:
+        scriptname = options.editscript
+    try:
+        if options.editscript == "-":
+            lines = sys.stdin.readlines()
+        else:
+            with open(options.editscript) as f:
+                lines = f.readlines()
+    except IOError as e:
+        e = file_error(e, options.editscript)
+        err(e.strerror)
+        return e.errno
+
+    # (line number, exit status, message) of each line in error
+    errors = []
+    # (sort key, names, value, line number) of each line, where the sort key
+    # keeps indexes from being compared to names
+    edits = []
+    for (lineno, line) in enumerate(lines, 1):
+        line = line.rstrip('\r\n')
+        if line.strip() == "":
+            continue
+        (name, value) = split_arg(line, options.sep[2])
+        if value is None:
+            errors.append( (lineno, exceptions.INVALID_VALUE,
+                            "Tag value not found: " + line) )
+            continue
+        try:
+            names = [] if name == "" else norbert_split_name(name, options.sep)
+        except ValueError:
+            errors.append( (lineno, exceptions.TAG_NOT_FOUND,
+                            "Invalid index: " + name) )
+            continue
+        key = tuple([ (isinstance(n, int), n) for n in names ])
+        edits.append( (key, names, value, lineno) )
+    edits.sort(key=lambda edit: edit[0])
+
+    # ancestors[i] is the tag named by the first i names of the last line
+    ancestors = [ nbtfile ]
+    last = ()
+    changes = []
+    for (key, names, value, lineno) in edits:
+        shared = 0
+        most = min(len(key), len(last), len(ancestors) - 1)
+        while shared < most and key[shared] == last[shared]:
+            shared += 1
+        del ancestors[shared + 1:]
+        for name in names[shared:]:
+            tag = norbert_child(ancestors[-1], name)
+            if tag is None:
+                break
+            ancestors.append(tag)
+        last = key
+
+        if len(ancestors) != len(names) + 1:
+            errors.append( (lineno, exceptions.TAG_NOT_FOUND,
+                            "Tag not found: " +
+                            norbert_join_name(names, options.sep)) )
+            continue
+
+        tag = ancestors[-1]
+        if tag.id not in value_parsers:
+            errors.append( (lineno, exceptions.TAG_NOT_IMPLEMENTED,
+                            "Writing for " + tag_types[tag.id] +
+                            " not implemented.") )
+            continue
+        try:
+            changes.append( (tag, value_parsers[tag.id](value)) )
+        except ValueError:
+            errors.append( (lineno, exceptions.TAG_CONVERSION_ERROR,
+                            "Couldn't convert " + value + " to " +
+                            tag_types[tag.id] + '.') )
+
+    if len(errors) != 0:
+        errors.sort()
+        for (lineno, errno, message) in errors:
+            err("%s:%d: %s" % (scriptname, lineno, message))
+        err(scriptname + ": No tags set")
+        return errors[0][1]
+
+    for (tag, value) in changes:
+        tag.value = value
+    runstats.count("tags set", len(changes))
+
+    return 0
+
+# prints the tags that differ between options.infile and options.difffile
+#
+# Each tag that is only in the input file is printed as it would be by
+# -p norbert, with every line prefixed by "-", and each tag that is only in
+# options.difffile the same way with "+". A tag that changed is printed as
+# both. Region files are compared a chunk at a time.
+#
+# returns: an exit status as diff(1) gives, 0 if the files have the same
+#          tags, FILES_DIFFER if any differences were printed, or
+#          DIFF_TROUBLE if the files couldn't be compared
+def norbert_diff(options):
+    from . import diff
+    if options.inputformat == "region":
+        return norbert_diff_region(options)
+
+    with runstats.phase("read"):
+        try:
+            old = read_data(options, options.infile)
+            new = read_data(options, options.difffile)
+        except IOError as e:
+            err(e.strerror)
+            return exceptions.DIFF_TROUBLE
+
+    with runstats.phase("diff"):
+        try:
+            differ = norbert_print_diff(diff.diff(old, new), options.sep)
+        except IOError as e:
+            # either file could be the malformed one
+            err("%s: '%s' or '%s'" % (str(e), options.infile,
+                                      options.difffile))
+            return exceptions.DIFF_TROUBLE
+        finally:
+            output.flush()
+
+    if differ:
+        return exceptions.FILES_DIFFER
+    return 0
+
+# compares two region files chunk by chunk, printing the differences in each
+# chunk after its coordinates, as with -i region
+#
+# returns: an exit status, as with norbert_diff()
+def norbert_diff_region(options):
+    from . import region
+    regionfiles = []
+    try:
+        for filename in [options.infile, options.difffile]:
+            try:
+                regionfiles.append(region.RegionFile(filename))
+            except IOError as e:
+                err(file_error(e, filename).strerror)
+                return exceptions.DIFF_TROUBLE
+
+        (old, new) = regionfiles
+        indexes = sorted(set(old.chunks()) | set(new.chunks()))
+        retval = 0
+        for index in indexes:
+            retval = max(retval, norbert_diff_chunk(old, new, index,
+                                                    options.sep))
+    finally:
+        for regionfile in regionfiles:
+            regionfile.close()
+        output.flush()
+
+    return retval
+
+# prints the differences in one chunk of two region files
+#
+# returns: an exit status, as with norbert_diff()
+def norbert_diff_chunk(old, new, index, sep=DEFAULT_SEP):
+    from . import diff, region
+    coords = "%d,%d" % region.chunk_coords(index)
+    try:
+        # chunks that weren't saved again are the same down to the byte
+        chunks = [ old.raw_chunk(index), new.raw_chunk(index) ]
+        if chunks[0] == chunks[1]:
+            return 0
+        for (i, chunk) in enumerate(chunks):
+            if chunk is not None:
+                chunks[i] = region.decompress_chunk(index, *chunk)
+        triplets = list(diff.diff(*chunks))
+    except IOError as e:
+        err("chunk " + coords + ": " + str(e))
+        return exceptions.DIFF_TROUBLE
+
+    if len(triplets) == 0:
+        return 0
+    output.write("chunk " + coords)
+    norbert_print_diff(triplets, sep)
+    return exceptions.FILES_DIFFER
+
+# reads the NBT data of a file as it would be read by options.inputformat,
+# without decoding it. Trees read from other formats are encoded
+#
+# returns: the NBT data
+# raises:  IOError if the file can't be read
+def read_data(options, filename):
+    import zlib
+    from . import stream
+    if options.inputformat not in ["nbt", "nbt-lazy", "nbt-stream"]:
+        import copy
+        options = copy.copy(options)
+        options.infile = filename
+        options.cachedir = None
+        nbtfile = read_file(options, [])
+        buf = io.BytesIO()
+        buf.write(stream.encode_header(nbtfile.id, nbtfile.name or ""))
+        nbtfile._render_buffer(buf)
+        return buf.getvalue()
+
+    try:
+        with stream.open_file(filename) as f:
+            data = f.read()
+    except (EOFError, zlib.error) as e:
+        raise file_error(IOError("Corrupt NBT data: " + str(e)), filename)
+    except IOError as e:
+        raise file_error(e, filename)
+
+    if data[:1] != b'\x0a':
+        raise file_error(IOError("Not an NBT file"), filename)
+
+    runstats.count("bytes read", os.path.getsize(filename))
+    runstats.count("bytes decompressed", len(data))
+    return data
+
+# prints the (sign, names, tag) triplets generated by diff.diff()
+#
+# returns: True if any were printed
+def norbert_print_diff(triplets, sep=DEFAULT_SEP):
+    from . import diff
+    printed = False
+    for (sign, names, tag) in triplets:
+        printed = True
+        if sign == diff.REMOVED:
+            runstats.count("tags removed")
+        else:
+            runstats.count("tags added")
+        print_subtags(tag, maxdepth=0, format="norbert", path=names, sep=sep,
+                      lines=PrefixWriter(output, sign))
+    return printed
+
+# returns: the tags on the way to the tag with the given names, starting with
+#          nbtfile and ending with the tag, or None if there is no such tag
+def norbert_find_ancestors(nbtfile, names):
+    tags = [ nbtfile ]
+    for name in names[1:]:
+        child = norbert_child(tags[-1], name)
+        if child is None:
+            return None
+        tags.append(child)
+
+    return tags
+
+# returns: the child of tag with a name or index from norbert_split_name(), or
+#          None if there isn't one
+def norbert_child(tag, name):
+    if tag.id == nbt.TAG_LIST and isinstance(name, int):
+        return child_at(tag, name)
+    elif tag.id == nbt.TAG_COMPOUND and not isinstance(name, int):
+        return find_child(tag, name)
+    return None
+
+# returns: the position of a child in tag.tags
+def norbert_position(tag, child):
+    for i, t in enumerate(tag.tags):
+        if t is child:
+            return i
+
+# returns: the norbert name of a list of names and indexes, the reverse of
+#          norbert_split_name()
+def norbert_join_name(names, sep=DEFAULT_SEP):
+    fullname = ""
+    for i, name in enumerate(names):
+        if isinstance(name, int):
+            fullname += sep[1] + str(name)
+        elif i == 0:
+            fullname += name
+        else:
+            fullname += sep[0] + name
+    return fullname
+
+# writes an NBT file with write_atomically()
+#
+# The file is gzipped at compresslevel by a compress.GzipWriter with the
+# given number of threads, or written uncompressed if compresslevel is 0.
+def write_file(nbtfile, filename, compresslevel=DEFAULT_COMPRESSLEVEL,
+               threads=1):
+    from . import compress
+    def write(f):
+        if compresslevel == 0:
+            nbtfile.write_file(buffer=f)
+            return
+        out = compress.GzipWriter(f, compresslevel, threads)
+        try:
+            nbtfile.write_file(buffer=out)
+        finally:
+            out.close()
+
+    write_atomically(filename, write)
+
+# writes a file by calling write(f) with a temporary file in the same
+# directory, opened for reading and writing, then renames it to filename, so
+# that filename is never left partly written
+#
+# The temporary file is synced to disk before it is renamed, and the
+# directory after, so that a crash leaves either the old file or the whole
+# new one. The new file gets the permissions of the one it replaces.
+def write_atomically(filename, write):
+    import shutil
+    import tempfile
+    dirname = os.path.dirname(filename) or os.curdir
+    (fd, tmpname) = tempfile.mkstemp(dir=dirname,
+                                     prefix='.' + os.path.basename(filename))
+    try:
+        with os.fdopen(fd, 'w+b') as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+
+        # give the new file the permissions of the one it replaces
+        if os.path.exists(filename):
+            shutil.copymode(filename, tmpname)
+        else:
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(tmpname, 0o666 & ~umask)
+
+        os.rename(tmpname, filename)
+    except:
+        os.remove(tmpname)
+        raise
+
+    sync_dir(dirname)
+
+# syncs a directory to disk, so that files renamed into it stay renamed
+def sync_dir(dirname):
+    try:
+        fd = os.open(dirname, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        # not every system can sync a directory
+        pass
+    finally:
+        os.close(fd)
+
+# calls fn on each item in jobs using a pool of options.jobs processes, or
+# in this process if options.jobs is 1 or not given
+#
+# initializer(*initargs) is called once in each process before any jobs.
+# Results are generated in the same order as jobs. If a job raises, or the
+# generator is closed before every result is taken, no more jobs are started
+# and only the ones already running are waited for. Pool.terminate() would
+# stop those too, but it can deadlock while a job is still being sent to a
+# process it killed.
+def map_jobs(options, fn, jobs, initializer=None, initargs=()):
+    processes = getattr(options, "jobs", 1)
+    if processes == 1 or len(jobs) <= 1:
+        if initializer is not None:
+            initializer(*initargs)
+        for job in jobs:
+            yield fn(job)
+        return
+
+    # the pool takes jobs from this as it hands them out
+    stopped = []
+    def remaining():
+        for job in jobs:
+            if stopped:
+                return
+            yield job
+
+    import multiprocessing
+    pool = multiprocessing.Pool(min(processes, len(jobs)), initializer,
+                                initargs)
+    try:
+        for result in pool.imap(fn, remaining(), chunksize=8):
+            yield result
+    finally:
+        stopped.append(True)
+        pool.close()
+        pool.join()
+
+# calls fn(*args), capturing any messages printed with err()
+#
+# returns: (return value of fn, messages)
+def capture_errors(fn, *args):
+    errors = io.StringIO()
+    saved = sys.stderr
+    sys.stderr = errors
+    try:
+        ret = fn(*args)
+    finally:
+        sys.stderr = saved
+
+    return (ret, errors.getvalue())
+
+# applies the <tag> arguments to each file listed in options.manifest
+#
+# Files are handled by a pool of options.jobs processes. Output is printed in
+# the order files are listed, each file's output preceded by its name. The
+# exit status of each file is printed to stderr.
+def norbert_batch(options, args):
+    try:
+        if options.manifest == "-":
+            lines = sys.stdin.readlines()
+        else:
+            with open(options.manifest) as f:
+                lines = f.readlines()
+    except IOError as e:
+        raise file_error(e, options.manifest)
+
+    jobs = []
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if line.strip() == "":
+            continue
+        (infile, tab, outfile) = line.partition('\t')
+        jobs.append( (options, args, infile, outfile or None) )
+
+    retval = 0
+    for (infile, r, text, errors) in map_jobs(options, norbert_batch_file,
+                                              jobs):
+        if text != "":
+            sys.stdout.write("file " + infile + '\n' + text)
+            sys.stdout.flush()
+        for line in errors.splitlines():
+            err(infile + ": " + line)
+        err(infile + ": exit " + str(r))
+
+        if r > retval:
+            retval = r
+
+    return retval
+
+# applies the <tag> arguments to one file of a batch
+#
+# returns: an (infile, retval, output, errors) tuple
+def norbert_batch_file(job):
+    (options, args, infile, outfile) = job
+    import copy
+    options = copy.copy(options)
+    options.infile = infile
+    options.outfile = outfile
+    out = io.StringIO()
+    (retval, errors) = capture_errors(norbert_file, options, args, out)
+    return (infile, retval, out.getvalue(), errors)
+
+# reads a file, applies the <tag> arguments to it, and writes it to
+# options.outfile if it is given
+#
+# returns: the exit status for the file
+def norbert_file(options, args, out):
+    try:
+        nbtfile = read_file(options, args)
+    except IOError as e:
+        err(file_error(e, options.infile).strerror)
+        return e.errno
+
+    retval = norbert_args(nbtfile, options, args, out=out)
+    if retval != 0 or options.outfile is None:
+        return retval
+
+    if not hasattr(nbtfile, "write_file"):
+        err("Can't write files read with -i " + options.inputformat)
+        return exceptions.INVALID_OPTION
+
+    # each file of a batch already has a process of its own
+    return norbert_write(nbtfile, options, threads=1)
+
+# writes an NBT tree to options.outfile with write_file(), compressed at
+# options.compresslevel by the given number of threads
+#
+# returns: an exit status
+def norbert_write(nbtfile, options, threads=1):
+    try:
+        write_file(nbtfile, options.outfile, options.compresslevel, threads)
+    except IOError as e:
+        err(file_error(e, options.outfile).strerror)
+        return e.errno
+    except (ValueError, TypeError) as e:
+        err("Couldn't encode file: " + str(e))
+        return exceptions.GENERAL_ERROR
+
+    runstats.count("bytes written", os.path.getsize(options.outfile))
+    return 0
+
+# applies each <tag> argument to an NBT tree
+#
+# If counts is given, queries are passed it, as with norbert_query().
+#
+# returns: the largest exit status of the arguments
+def norbert_args(nbtfile, options, args, out=None, counts=None):
+    from . import stream
+    if isinstance(nbtfile, stream.NBTStream):
+        cache = None
+    else:
+        cache = PathCache(nbtfile)
+
+    retval = 0
+    for arg in args:
+        r = norbert(nbtfile, options, arg, out=out, cache=cache,
+                    counts=counts)
+        if r > retval:
+            retval = r
+
+    return retval
+
+# the region file opened by a norbert_chunk() worker process
+region_worker = None
+
+def init_region_worker(filename):
+    global region_worker
+    from . import region
+    region_worker = region.RegionFile(filename)
+
+# applies the <tag> arguments to every chunk in a region file
+#
+# Chunks are decoded and handled by a pool of options.jobs processes. Output
+# is printed in chunk order, each chunk's output preceded by its
+# coordinates. If options.outfile is given, only the chunks that were
+# modified are written to it. A query is only an error if it matches nothing
+# in any chunk.
+def norbert_region(options, args):
+    from . import region
+    try:
+        regionfile = region.RegionFile(options.infile)
+        indexes = regionfile.chunks()
+        regionfile.close()
+    except IOError as e:
+        raise file_error(e, options.infile)
+
+    jobs = [ (options, args, i) for i in indexes ]
+    results = map_jobs(options, norbert_chunk, jobs,
+                       init_region_worker, (options.infile,))
+
+    retval = 0
+    chunks = {}
+    counts = dict( (arg, 0) for arg in args )
+    for (index, r, text, errors, data, matched) in results:
+        coords = "%d,%d" % region.chunk_coords(index)
+        if text != "":
+            sys.stdout.write("chunk " + coords + '\n' + text)
+            sys.stdout.flush()
+        for line in errors.splitlines():
+            err("chunk " + coords + ": " + line)
+
+        if r > retval:
+            retval = r
+        if data is not None:
+            chunks[index] = data
+        for (arg, n) in matched.items():
+            counts[arg] += n
+
+    if options.query:
+        for arg in args:
+            if counts[arg] == 0:
+                err("No tags match: " + split_query(arg, options.sep)[0])
+                retval = max(retval, exceptions.TAG_NOT_FOUND)
+
+    if retval != 0:
+        return retval
+
+    # write file if necessary. A copy of the file is changed and renamed
+    # over outfile, as write_file() does, so it's never left partly written
+    if options.outfile is None:
+        return 0
+    try:
+        if len(chunks) == 0 and os.path.exists(options.outfile) and \
+           os.path.samefile(options.infile, options.outfile):
+            # nothing to change
+            return 0
+
+        def write(f):
+            import shutil
+            with open(options.infile, 'rb') as original:
+                shutil.copyfileobj(original, f)
+            region.write_chunks(f, chunks)
+        write_atomically(options.outfile, write)
+    except IOError as e:
+        raise file_error(e, options.outfile)
+
+    return 0
+
+# applies the <tag> arguments to one chunk of the region file opened by
+# init_region_worker()
+#
+# returns: an (index, retval, output, errors, data, matched) tuple, where
+#          data is the chunk's new NBT data if it was modified, or None, and
+#          matched is a dict of the number of tags each query argument
+#          matched in the chunk
+def norbert_chunk(job):
+    (options, args, index) = job
+    out = io.StringIO()
+    ((retval, data, matched), errors) = capture_errors(norbert_chunk_args,
+                                                       options, args, index,
+                                                       out)
+    return (index, retval, out.getvalue(), errors, data, matched)
+
+# returns: (retval, data, matched) as in norbert_chunk()
+def norbert_chunk_args(options, args, index, out):
+    from . import arrays
+    matched = {}
+    try:
+        data = region_worker.read_chunk(index)
+        nbtfile = arrays.NBTFile(buffer=io.BytesIO(data))
+    except (IOError, ValueError, nbt.MalformedFileError) as e:
+        err(str(e))
+        return (exceptions.GENERAL_ERROR, None, matched)
+
+    retval = norbert_args(nbtfile, options, args, out=out, counts=matched)
+    if retval != 0:
+        return (retval, None, matched)
+
+    # chunks where no query matched are left as they are
+    if options.query:
+        modified = any( split_query(arg, options.sep)[1] is not None and
+                        matched[arg] != 0
+                        for arg in args )
+    else:
+        modified = any( split_arg(arg, options.sep[2])[1] is not None
+                        for arg in args )
+    if not modified:
+        return (0, None, matched)
+
+    buf = io.BytesIO()
+    try:
+        nbtfile.write_file(buffer=buf)
+    except (ValueError, TypeError) as e:
+        err("Couldn't encode chunk: " + str(e))
+        return (exceptions.GENERAL_ERROR, None, matched)
+
+    return (0, buf.getvalue(), matched)
+
+def norbert(nbtfile, options, arg, out=None, cache=None, counts=None):
+    from . import stream
+    if options.query:
+        return norbert_query(nbtfile, options, arg, out=out, cache=cache,
+                             counts=counts)
+
     name, value = split_arg(arg, options.sep[2])
 
-    tag = get_tag(nbtfile, name, sep=options.sep)
+    # streams are copied to binary output without being decoded
+    if value is None and options.format == "nbt" and \
+       isinstance(nbtfile, stream.NBTStream):
+        return norbert_copy(nbtfile, options, name)
+
+    try:
+        with runstats.phase("lookup"):
+            if cache is not None:
+                tag = cache.resolve(compile_path(name, options.sep))
+            else:
+                tag = get_tag(nbtfile, name, sep=options.sep)
+    except IOError as e:
+        # streams are only read as tags are looked up
+        err(str(e) + ": '" + options.infile + "'")
+        return exceptions.GENERAL_ERROR
+
     if tag is None:
         err("Tag not found: " + name)
         return exceptions.TAG_NOT_FOUND
 
     if value == None:
-        # print the tag and its subtags
-        print_subtags(tag, maxdepth=options.maxdepth, format=options.format)
+        # print the tag and its subtags, under the name it was looked up by,
+        # so that elements of TAG_List's keep the name of their list
+        path = None
+        if name != "":
+            path = [ name ]
+        with runstats.phase("print"):
+            print_subtags(tag, maxdepth=options.maxdepth,
+                          format=options.format, out=out, path=path,
+                          sep=options.sep)
         return 0
     else:
         # set the tag
-        return set_tag(tag, value)
+        with runstats.phase("set"):
+            return set_tag(tag, value)
+
+# prints or sets every tag matched by a query argument
+#
+# Each tag is printed as soon as it is found, under its full name from the
+# root, so the norbert format prints the same lines as a dump of the whole
+# file would.
+#
+# If counts is given, the number of tags matched is added to counts[arg],
+# and a query that matches nothing isn't an error. Region files are queried
+# this way, since most chunks won't have a match.
+#
+# returns: an exit status
+def norbert_query(nbtfile, options, arg, out=None, cache=None, counts=None):
+    from . import stream
+    try:
+        (name, value) = split_query(arg, options.sep)
+        query = compile_query(name, options.sep)
+    except ValueError as e:
+        err("Invalid query: %s: %s" % (e, arg))
+        return exceptions.INVALID_VALUE
+
+    if isinstance(nbtfile, stream.NBTStream):
+        cache = None
+    matches = query.select(nbtfile, cache=cache, pin=value is not None)
+
+    matched = 0
+    while True:
+        try:
+            with runstats.phase("lookup"):
+                (names, tag) = next(matches, (None, None))
+        except IOError as e:
+            # streams are only read as tags are looked up
+            err(str(e) + ": '" + options.infile + "'")
+            return exceptions.GENERAL_ERROR
+        if tag is None:
+            break
+
+        matched += 1
+        runstats.count("tags matched")
+        if value is None:
+            with runstats.phase("print"):
+                print_subtags(tag, maxdepth=options.maxdepth,
+                              format=options.format, out=out, path=names,
+                              sep=options.sep)
+        else:
+            with runstats.phase("set"):
+                retval = set_tag(tag, value)
+            if retval != 0:
+                return retval
+
+    if counts is not None:
+        counts[arg] = counts.get(arg, 0) + matched
+    elif matched == 0:
+        err("No tags match: " + name)
+        return exceptions.TAG_NOT_FOUND
+
+    return 0
+
+def norbert_copy(nbtstream, options, name):
+    out = BinaryWriter()
+    try:
+        if name == "":
+            found = nbtstream.copy_tag([], out)
+        else:
+            found = nbtstream.copy_tag(norbert_split_name(name, options.sep),
+                                       out)
+    except ValueError:
+        found = False
+    except IOError as e:
+        err(str(e) + ": '" + options.infile + "'")
+        return exceptions.GENERAL_ERROR
+    finally:
+        out.close()
+
+    if not found:
+        err("Tag not found: " + name)
+        return exceptions.TAG_NOT_FOUND
+
+    return 0
 
 def split_arg(namevaluepair, sep):
     name, type, value = norbert_split_line(namevaluepair, sep)
     return (name, value)
 
 def get_tag(tag, fullname, sep=DEFAULT_SEP):
-    if fullname == "":
+    from . import stream
+    if isinstance(tag, stream.NBTStream):
+        try:
+            if fullname == "":
+                return tag.get_tag([])
+            return tag.get_tag(norbert_split_name(fullname, sep))
+        except ValueError:
+            return None
+
+    return compile_path(fullname, sep).resolve(tag)
+
+# parses a norbert name into a Path
+#
+# Paths are cached, so each name is only parsed once for a given sep. The
+# cache is emptied whenever it fills up.
+def compile_path(fullname, sep=DEFAULT_SEP):
+    key = (fullname, sep)
+    path = compiled_paths.get(key)
+    if path is None:
+        if len(compiled_paths) >= COMPILED_PATHS:
+            compiled_paths.clear()
+        path = compiled_paths[key] = Path(fullname, sep)
+    return path
+
+# the cache of compile_path(), by (fullname, sep)
+compiled_paths = {}
+
+# a norbert name, parsed into a tuple of segments
+#
+# Each segment is the text between two sep[0]'s. Like get_tag has always
+# done, a segment is looked up by its literal name in a TAG_Compound, as an
+# index in a TAG_List, and then as a name followed by indexes. Each segment
+# is a (literal, name, indexes, number) tuple, where
+#
+#   literal:  the segment as given
+#   name:     the part of literal before the first sep[1]
+#   indexes:  a tuple of the integers after each sep[1], or None if there are
+#             none or they aren't all integers
+#   number:   literal as an integer, or None if it isn't one
+#
+class Path(object):
+    def __init__(self, fullname, sep=DEFAULT_SEP):
+        self.fullname = fullname
+        if fullname == "":
+            self.segments = ()
+        else:
+            self.segments = tuple([ parse_segment(literal, sep[1])
+                                    for literal in fullname.split(sep[0]) ])
+
+    # returns: the tag with this name under root, or None if there isn't one
+    def resolve(self, root):
+        tag = root
+        for segment in self.segments:
+            tag = resolve_segment(tag, segment)
+            if tag is None:
+                return None
         return tag
 
+def parse_segment(literal, sep):
+    name = literal
+    indexes = None
+    number = None
+
+    if sep in literal:
+        nameindex = literal.split(sep)
+        name = nameindex.pop(0)
+        if all( is_integer(i) for i in nameindex ):
+            indexes = tuple([ int(i) for i in nameindex ])
+
+    if is_integer(literal):
+        number = int(literal)
+
+    return (literal, name, indexes, number)
+
+def is_integer(s):
     try:
-        for i in fullname.split(sep[0]):
-            try:
-                tag = tag[i]
-            except TypeError as e:
-                tag = tag[int(i)]
-            except KeyError as e:
-                (i, indexes) = split_name(i, sep[1])
-                tag = tag[i]
-                for j in indexes:
-                    tag = tag[j]
-    except (KeyError, ValueError, TypeError, IndexError) as e:
+        int(s)
+    except ValueError:
+        return False
+    return True
+
+# returns: the child of tag that a segment of a Path refers to, or None
+def resolve_segment(tag, segment):
+    (literal, name, indexes, number) = segment
+    if tag.id == nbt.TAG_LIST:
+        if number is None:
+            return None
+        return child_at(tag, number)
+    elif tag.id != nbt.TAG_COMPOUND:
         return None
 
-    return tag
+    child = find_child(tag, literal)
+    if child is not None or indexes is None:
+        return child
+
+    child = find_child(tag, name)
+    for i in indexes:
+        if child is None:
+            return None
+        child = child_at(child, i)
+
+    return child
+
+# returns: the first child of a TAG_Compound with the given name, or None
+def find_child(tag, name):
+    tags = tag.tags
+    if len(tags) < INDEX_MIN_TAGS:
+        for child in tags:
+            if child.name == name:
+                return child
+        return None
+
+    # an index that was already built may be stale even if the number of
+    # children is the same, since children can be replaced in place, as
+    # norbert_patch() and lazy.WindowedList do. It's built again whenever a
+    # name isn't where it says, or isn't in it at all
+    built = name_is_indexed(tag)
+    index = name_index(tag)
+    i = index[1].get(name)
+    if built and (i is None or tags[i].name != name):
+        index = name_index(tag, rebuild=True)
+        i = index[1].get(name)
+
+    if i is None:
+        return None
+    return tags[i]
+
+# returns: True if a TAG_Compound has an index of its children by name that
+#          name_index() would use without building it again
+def name_is_indexed(tag):
+    index = getattr(tag, "nameindex", None)
+    return index is not None and index[0] == len(tag.tags)
+
+# returns the index of a TAG_Compound's children by name, building it if
+# necessary
+#
+# The index is stored in the tag's nameindex attribute as a [length, dict]
+# pair, where dict maps names to positions in tag.tags and length is the
+# number of tags it was built from. If tags have been added or removed since
+# then, or rebuild is True, it is built again.
+def name_index(tag, rebuild=False):
+    if rebuild or not name_is_indexed(tag):
+        positions = {}
+        for i, child in enumerate(tag.tags):
+            positions.setdefault(child.name, i)
+        tag.nameindex = [len(tag.tags), positions]
+    return tag.nameindex
+
+# returns: the child at index i of a TAG_List or TAG_Compound, or None
+def child_at(tag, i):
+    if tag.id not in complex_tag_types:
+        return None
 
-def split_name(nameindexlist, sep):
-    nameindex = nameindexlist.split(sep)
+    tags = tag.tags
+    if not -len(tags) <= i < len(tags):
+        return None
+    elif hasattr(tags, "pin"):
+        # a lazy.WindowedList, which would otherwise let go of the tag, and
+        # any changes made to it
+        return tags.pin(i)
+    return tags[i]
+
+# resolves Paths under a root tag, remembering the tags found along the way
+#
+# Paths that share a prefix only look up the tags in the prefix once. The
+# cache holds tags, not values, so it stays valid when tags are changed with
+# set_tag(). It must be cleared if tags are added or removed.
+class PathCache(object):
+    def __init__(self, root):
+        self.root = root
+        self.clear()
+
+    def clear(self):
+        # a trie of [tag, {segment: child node}] nodes
+        self.trie = [self.root, {}]
+
+    # returns: the tag with path's name under root, or None if there isn't one
+    def resolve(self, path):
+        node = self.trie
+        for segment in path.segments:
+            child = node[1].get(segment)
+            if child is None:
+                tag = resolve_segment(node[0], segment)
+                if tag is None:
+                    return None
+                child = [tag, {}]
+                node[1][segment] = child
+            node = child
+        return node[0]
+
+# A query is a norbert name that can match more than one tag, given as a <tag>
+# argument with -q. Each segment of the name, the text between two sep[0]'s,
+# is a selector followed by any number of predicates:
+#
+#   selector:   a name and indexes, as in a Path, except that a name or index
+#               of "*" matches every child of a TAG_Compound or TAG_List, and
+#               a name with "*" or "?" in it matches the names of children of
+#               a TAG_Compound like a shell glob
+#   predicate:  "[name]" or "[name op value]", where name is a Path relative
+#               to the selected tag and op is one of =, !=, <, <=, > or >=.
+#               The first form matches if there is a tag with that name, the
+#               second if there is and its value compares to value with op.
+#               An empty name is the selected tag itself
+#
+# e.g. "Entities#*[id=Zombie][Health<10]" matches every element of the
+# Entities list with an id of Zombie and a Health below 10. A query may be
+# followed by sep[2] and a value, outside of any predicate, to set every tag
+# it matches.
+#
+# Tags are matched by walking down the tree a segment at a time, so only the
+# children a segment selects are visited, and subtrees that can't match are
+# never printed. They are still decoded: the segments at the start of a query
+# with no wildcards or predicates are looked up like any other name first, so
+# they can go through a PathCache or an NBTStream's index, but the tag they
+# lead to is then loaded whole, even from an NBTStream, before the rest of
+# the query is matched against it.
+
+# the operators of predicates, longest first so that "<=" isn't read as "<",
+# each with the name of the function in the operator module that does it
+query_ops = [
+    ("!=", "ne"),
+    ("<=", "le"),
+    (">=", "ge"),
+    ("=",  "eq"),
+    ("<",  "lt"),
+    (">",  "gt"),
+]
+# patterns for the re module, which caches them once compiled. None of the
+# operators are special characters
+query_op = '|'.join( op for (op, fn) in query_ops )
+query_predicates = r'(?:\[[^\]]*\])*\Z'
+query_predicate = r'\[([^\]]*)\]'
+
+# splits a query argument into the query and the value after sep[2], if any
+#
+# returns: (query, value), where value is None if the argument has no value
+# raises:  ValueError if a predicate isn't closed
+def split_query(arg, sep):
+    parts = split_outside_brackets(arg, sep[2], 1)
+    if len(parts) == 1:
+        return (arg.strip(), None)
+    return (parts[0].strip(), split_arg(sep[2] + parts[1], sep[2])[1])
+
+# splits text at each occurrence of sep outside of "[...]", up to maxsplit
+# times if maxsplit isn't negative
+#
+# returns: a list of the parts of text
+# raises:  ValueError if a "[" isn't closed
+def split_outside_brackets(text, sep, maxsplit=-1):
+    parts = []
+    start = 0
+    inside = False
+    for (i, c) in enumerate(text):
+        if inside:
+            inside = c != ']'
+        elif c == '[':
+            inside = True
+        elif c == sep and maxsplit != len(parts):
+            parts.append(text[start:i])
+            start = i + 1
+
+    if inside:
+        raise ValueError("unclosed '['")
+    parts.append(text[start:])
+    return parts
+
+# parses a query into a Query
+#
+# Queries are cached like Paths are by compile_path().
+def compile_query(query, sep=DEFAULT_SEP):
+    key = (query, sep)
+    compiled = compiled_queries.get(key)
+    if compiled is None:
+        if len(compiled_queries) >= COMPILED_QUERIES:
+            compiled_queries.clear()
+        compiled = compiled_queries[key] = Query(query, sep)
+    return compiled
+
+# the cache of compile_query(), by (query, sep)
+compiled_queries = {}
+
+# a query, parsed into the name of the tag it starts from and a list of steps
+# that select tags below it
+#
+# Each step selects children of the tags matched by the step before, and
+# is a (kind, arg, predicates) tuple, where kind is
+#
+#   "key":    arg is the name of a child, or the index of a list element
+#   "index":  arg is an integer index
+#   "all":    every child is selected, and arg is None
+#   "glob":   arg is a compiled regular expression matching names
+#
+# and predicates is a list of Predicate's each child must match.
+class Query(object):
+    def __init__(self, query, sep=DEFAULT_SEP):
+        import re
+        self.query = query
+        self.sep = sep
+        self.steps = []
+        if query == "":
+            segments = []
+        else:
+            segments = split_outside_brackets(query, sep[0])
+
+        # the segments before the first with a wildcard or predicate. Those
+        # with negative indexes are left to the steps, so that matches are
+        # named by position
+        prefix = []
+        for segment in segments:
+            if len(self.steps) == 0 and not re.search(r'[*?\[]', segment) \
+               and sep[1] + '-' not in segment:
+                prefix.append(segment)
+            else:
+                self.steps.extend(parse_query_segment(segment, sep))
+
+        self.prefix = sep[0].join(prefix)
+        if len(prefix) == 0:
+            self.names = []
+        else:
+            self.names = norbert_split_name(self.prefix, sep)
+
+    # finds the tags under root that match the query
+    #
+    # If cache is given, it is used to find the tag the query starts from. If
+    # pin is True, matched elements of lazy.WindowedList's are kept, so that
+    # they can be changed.
+    #
+    # yields: (names, tag) for each match, where names is the name of root
+    #         followed by the names and indexes leading to tag, like the path
+    #         passed to traversal actions
+    def select(self, root, cache=None, pin=False):
+        from . import stream
+        if cache is not None:
+            tag = cache.resolve(compile_path(self.prefix, self.sep))
+        else:
+            tag = get_tag(root, self.prefix, self.sep)
+        if tag is None:
+            return
+
+        if isinstance(root, stream.NBTStream):
+            names = [ root.root_name() ]
+        else:
+            names = [ root.name or "" ]
+        names.extend(self.names)
+        for match in self.walk(tag, 0, names, pin):
+            yield match
+
+    # yields: (names, tag) for each tag matched by the steps from step k on,
+    #         starting from tag, whose names are given
+    def walk(self, tag, k, names, pin):
+        if k == len(self.steps):
+            yield (list(names), tag)
+            return
+
+        (kind, arg, predicates) = self.steps[k]
+        for (key, child) in query_children(tag, kind, arg):
+            if not all( p.matches(child) for p in predicates ):
+                continue
+
+            names.append(key)
+            for match in self.walk(child, k + 1, names, pin):
+                if pin and isinstance(key, int):
+                    child_at(tag, key)
+                yield match
+            names.pop()
+
+# returns: a list of the steps of one segment of a query
+# raises:  ValueError if the segment isn't a valid selector and predicates
+def parse_query_segment(segment, sep):
+    import re
+    (selector, bracket, predicates) = segment.partition('[')
+    predicates = bracket + predicates
+    if re.match(query_predicates, predicates) is None:
+        raise ValueError("text after predicate")
+    predicates = [ Predicate(text, sep)
+                   for text in re.findall(query_predicate, predicates) ]
+
+    nameindex = selector.split(sep[1])
     name = nameindex.pop(0)
-    indexes = [ int(i) for i in nameindex ]
+    if name == "*":
+        steps = [ ["all", None] ]
+    elif '*' in name or '?' in name:
+        pattern = re.escape(name).replace(r'\*', '.*').replace(r'\?', '.')
+        steps = [ ["glob", re.compile(pattern + r'\Z', re.DOTALL)] ]
+    else:
+        steps = [ ["key", name] ]
+
+    for index in nameindex:
+        if index == "*":
+            steps.append( ["all", None] )
+        elif is_integer(index):
+            steps.append( ["index", int(index)] )
+        else:
+            raise ValueError("invalid index: " + index)
 
-    return (name, indexes)
+    return [ (kind, arg, []) for (kind, arg) in steps[:-1] ] + \
+           [ (steps[-1][0], steps[-1][1], predicates) ]
+
+# yields: (key, child) for the children of tag selected by a step of a
+#         Query, where key is the child's name, or its index in a TAG_List
+def query_children(tag, kind, arg):
+    if tag.id not in complex_tag_types:
+        return
+    tags = tag.tags
+
+    if kind == "key":
+        if tag.id == nbt.TAG_COMPOUND:
+            child = find_child(tag, arg)
+            if child is not None:
+                yield (arg, child)
+        elif is_integer(arg):
+            kind = "index"
+            arg = int(arg)
+
+    if kind == "index":
+        if arg < 0:
+            arg += len(tags)
+        child = child_at(tag, arg)
+        if child is None:
+            return
+        elif tag.id == nbt.TAG_LIST:
+            yield (arg, child)
+        else:
+            yield (child.name, child)
+
+    elif kind == "all" and tag.id == nbt.TAG_LIST:
+        for i in range(len(tags)):
+            yield (i, tags[i])
+
+    elif kind == "all":
+        for child in tags:
+            yield (child.name, child)
+
+    elif kind == "glob" and tag.id == nbt.TAG_COMPOUND:
+        match = arg.match
+        for child in tags:
+            if match(child.name):
+                yield (child.name, child)
+
+# a predicate of a Query, e.g. "[id=Zombie]"
+class Predicate(object):
+    def __init__(self, text, sep=DEFAULT_SEP):
+        import operator
+        import re
+        found = re.search(query_op, text)
+        if found is None:
+            (name, self.op, self.value) = (text, None, None)
+        else:
+            name = text[:found.start()]
+            self.op = getattr(operator, dict(query_ops)[found.group()])
+            self.value = norbert_unescape(text[found.end():].strip())
+        self.path = compile_path(name.strip(), sep)
+        # value, converted to the type of each tag it's compared to, or None
+        # if it can't be
+        self.values = {}
+
+    # returns: True if tag matches the predicate
+    def matches(self, tag):
+        tag = self.path.resolve(tag)
+        if tag is None:
+            return False
+        elif self.op is None:
+            return True
+
+        if tag.id not in self.values:
+            try:
+                self.values[tag.id] = value_parsers[tag.id](self.value)
+            except (KeyError, ValueError):
+                self.values[tag.id] = None
+
+        value = self.values[tag.id]
+        if value is None:
+            return False
+        return self.op(tag.value, value)
 
 # sets the value of a tag
 #
@@ -430,59 +2330,184 @@ def split_name(nameindexlist, sep):
 #          TAG_NOT_IMPLEMENTED if tag type not implemented,
 #          TAG_CONVERSION_ERROR if value couldn't be converted
 def set_tag(tag, value):
+    if tag.id not in value_parsers:
+        err("Writing for " + tag_types[tag.id] + " not implemented.")
+        return exceptions.TAG_NOT_IMPLEMENTED
+
     try:
-        if tag.id == nbt.TAG_BYTE:
-            # convert to integer
-            tag.value = int(value)
-        elif tag.id == nbt.TAG_SHORT:
-            # convert to integer
-            tag.value = int(value)
-        elif tag.id == nbt.TAG_INT:
-            # convert to integer
-            tag.value = int(value)
-        elif tag.id == nbt.TAG_LONG:
-            # convert to integer
-            tag.value = int(value)
-        elif tag.id == nbt.TAG_FLOAT:
-            # convert to float
-            tag.value = float(value)
-        elif tag.id == nbt.TAG_DOUBLE:
-            # convert to float
-            tag.value = float(value)
-        elif tag.id == nbt.TAG_BYTE_ARRAY:
-            # convert to list of int's
-            tag.value = [ int(i) for i in value.split(',') ]
-        elif tag.id == nbt.TAG_INT_ARRAY:
-            # convert to list of int's
-            tag.value = [ int(i) for i in value.split(',') ]
-        elif tag.id == nbt.TAG_STRING:
-            # no conversion needed
-            tag.value = value
-        else:
-            err("Writing for " + tag_types[tag.id] + " not implemented.")
-            return exceptions.TAG_NOT_IMPLEMENTED
-    except ValueError as e:
+        tag.value = value_parsers[tag.id](value)
+    except ValueError:
         err("Couldn't convert " + value + " to " + tag_types[tag.id] + '.')
         return exceptions.TAG_CONVERSION_ERROR
 
     return 0
 
+# parses the value of a TAG_Byte_Array with arrays.parse_bytes()
+def parse_bytes(value):
+    from . import arrays
+    return arrays.parse_bytes(value)
+
+# parses the value of a TAG_Int_Array with arrays.parse_ints()
+def parse_ints(value):
+    from . import arrays
+    return arrays.parse_ints(value)
+
+# converts norbert values to the values of tags, by tag type
+value_parsers = {
+    nbt.TAG_BYTE:       int,
+    nbt.TAG_SHORT:      int,
+    nbt.TAG_INT:        int,
+    nbt.TAG_LONG:       int,
+    nbt.TAG_FLOAT:      float,
+    nbt.TAG_DOUBLE:     float,
+    nbt.TAG_BYTE_ARRAY: parse_bytes,
+    nbt.TAG_INT_ARRAY:  parse_ints,
+    nbt.TAG_STRING:     str
+}
+
 # print a message to stderr
 def err(message):
     sys.stderr.write(message + '\n')
 
+# buffers lines of output and writes them to a file in bulk
+#
+# Formatters write each line they produce with output.write(). Lines are
+# joined and written out whenever bufsize characters have accumulated, and
+# when flush() is called. If f is None, lines are written to whatever
+# sys.stdout is at the time of the flush.
+class LineWriter(object):
+    def __init__(self, f=None, bufsize=DEFAULT_BUFSIZE):
+        self.file = f
+        self.bufsize = bufsize
+        self.lines = []
+        self.size = 0
+
+    def write(self, line):
+        self.lines.append(line)
+        self.size += len(line)
+        if self.size >= self.bufsize:
+            self.flush()
+
+    def flush(self):
+        if len(self.lines) != 0:
+            f = self.file
+            if f is None:
+                f = sys.stdout
+            runstats.count("lines printed", len(self.lines))
+            self.lines.append('')
+            text = '\n'.join(self.lines)
+            runstats.count("bytes printed", len(text))
+            f.write(text)
+            self.lines = []
+            self.size = 0
+
+# where formatters send their output
+output = LineWriter()
+
+# writes lines to another LineWriter with a prefix, such as the "-" or "+"
+# of a line printed by -D
+class PrefixWriter(object):
+    def __init__(self, out, prefix):
+        self.out = out
+        self.prefix = prefix
+
+    def write(self, line):
+        self.out.write(self.prefix + line)
+
+    # lines are flushed with the LineWriter they're written to
+    def flush(self):
+        pass
+
+# records nothing, standing in for a stats.Stats until --stats is given, so
+# that the stats module is only imported then
+class NoStats(object):
+    enabled = False
+
+    # returns: a context manager that does nothing, for a with statement
+    def phase(self, name):
+        return self
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        return False
+
+    def count(self, name, n=1):
+        pass
+
+    def wrap_actions(self, pre_action, post_action):
+        return (pre_action, post_action)
+
+# what --stats records
+runstats = NoStats()
+
+# writes binary data to the file that a LineWriter writes to, output by
+# default
+#
+# The data is gzipped at compresslevel, unless it is 0. Nothing is written,
+# not even a gzip header, until write() is first called. Any lines waiting
+# in the LineWriter are flushed first, so text and binary output stay in
+# order.
+class BinaryWriter(object):
+    compresslevel = DEFAULT_COMPRESSLEVEL
+
+    def __init__(self, lines=None):
+        if lines is None:
+            lines = output
+        self.lines = lines
+        self.file = None
+        self.gzip = None
+        # bytes written, before compression
+        self.size = 0
+
+    def open(self):
+        from . import compress
+        self.lines.flush()
+        f = self.lines.file
+        if f is None:
+            f = sys.stdout
+        f.flush()
+        self.file = getattr(f, "buffer", f)
+        if self.compresslevel != 0:
+            self.gzip = compress.GzipWriter(self.file, self.compresslevel)
+
+    def write(self, data):
+        if self.file is None:
+            self.open()
+        self.size += len(data)
+        if self.gzip is not None:
+            self.gzip.write(data)
+        else:
+            self.file.write(data)
+
+    def close(self):
+        runstats.count("bytes printed", self.size)
+        if self.gzip is not None:
+            self.gzip.close()
+        if self.file is not None:
+            self.file.flush()
+
 # do nothing with a tag
 #
-# parameters:
-#   tag: the tag to do nothing with
-#   depth: the depth from the root ancestor tag
-def nothing(tag, depth=None):
+# Takes any arguments, so it can stand in for a traversal action or any of a
+# formatter's actions.
+def nothing(*args):
     pass
 
-def is_parent_of(parent, child):
-    return parent.id in complex_tag_types and child in parent.tags
-
-# does a traversal of a tag and its subtags
+# does a depth-first traversal of a tag and its subtags
+#
+# Each tag is entered and left exactly once, so the total cost is linear in
+# the number of tags visited.
+#
+# Actions are called as action(tag, depth, path), where depth is the depth of
+# tag below the root and path is a list of the names leading to it: the name
+# of the root, followed by the name of each TAG_Compound child or index of
+# each TAG_List element on the way to tag. path is changed as the traversal
+# goes on, so actions must copy it to keep it. Tags aren't modified and the
+# traversal keeps no state outside this call, so a tree can be traversed any
+# number of times, or by several traversals at once, as long as the actions
+# don't share state either.
 #
 # parameters
 # ----------
@@ -490,164 +2515,381 @@ def is_parent_of(parent, child):
 #   pre_action:    preorder action
 #   post_action:   postorder action
 #   maxdepth:      maximum depth level
+#   path:          the names leading to tag, if it isn't the root of its
+#                  tree, such as those of a Query match. Default is
+#                  [tag.name]
 def traverse_subtags(tag, maxdepth=DEFAULT_MAXDEPTH,
-                     pre_action=nothing, post_action=nothing):
-    # stack: a list of (tag, int) pairs
-    # cur:   the current tag
-    # prev:  the previous tag
-    # c:     the index to the sibling to cur's right
-    # p:     the index to the sibling to prev's right
-    #
-    #
-    #     parent
-    #      / \
-    #   cur   parent.tags[c]
+                     pre_action=nothing, post_action=nothing, path=None):
+    # stack: a list of [tag, int] pairs
     #
+    # The int is the index of the next child of tag to visit. Tags on the
+    # stack are the ancestors of the tag currently being visited, so the
+    # length of the stack is the depth of the top tag plus one, and the
+    # length of path without the names leading to the root.
 
     if tag == None:
         return
 
-    stack = [ (tag, None) ]
-    pre_action(tag)
-    (prev, p) = (None, None)
-
-    while len(stack) != 0:
-        # get cur from top of the stack
-        (cur, c) = stack[-1]
-
-        # if cur is the root or a child of prev
-        if len(stack) != maxdepth and \
-           ( prev == None or is_parent_of(prev, cur) ):
-            if cur.id in complex_tag_types and len(cur.tags) != 0:
-                # push cur's first child on stack
-                push_child(stack, cur, 0)
+    (pre_action, post_action) = runstats.wrap_actions(pre_action, post_action)
 
-                # perform preorder action on newly added item
-                pre_action(stack[-1][0])
+    if path is None:
+        path = [ tag.name ]
+    else:
+        path = list(path)
+    pre_action(tag, 0, path)
+    stack = [ [tag, 0] ]
 
-        # if prev is a child of cur
-        elif len(stack) != maxdepth and is_parent_of(cur, prev):
-            # push cur's next child (prev's sibling) on stack
-            if p is not None:
-                push_child(stack, cur, p)
+    while len(stack) != 0:
+        top = stack[-1]
+        cur = top[0]
+
+        if len(stack) != maxdepth and cur.id in complex_tag_types \
+           and top[1] < len(cur.tags):
+            # push cur's next child on the stack
+            i = top[1]
+            child = cur.tags[i]
+            top[1] += 1
+            if cur.id == nbt.TAG_LIST:
+                path.append(i)
+            else:
+                path.append(child.name)
 
-                # perform preorder action on newly added item
-                pre_action(stack[-1][0])
+            # perform preorder action on newly added item
+            pre_action(child, len(stack), path)
+            stack.append( [child, 0] )
 
-        # cur and prev are identical
         else:
-            # perform postorder action on cur and pop it
-            post_action(cur)
+            # all of cur's children are done,
+            # so perform postorder action on cur and pop it
+            post_action(cur, len(stack) - 1, path)
             stack.pop()
+            path.pop()
 
-        (prev, p) = (cur, c)
-
-# pushes a child and the index of the next child (if any) on the stack
-def push_child(stack, parent, i):
-    if len(parent.tags) > i + 1:
-        stack.append( (parent.tags[i], i + 1) )
-    else:
-        stack.append( (parent.tags[i], None) )
-
-def print_subtags(tag, maxdepth=DEFAULT_MAXDEPTH, format=DEFAULT_PRINTFORMAT):
+# prints a tag and its subtags
+#
+# Each formatter is an (init, pre, post, done) tuple of actions. They're all
+# passed a PrintState made for this call as their first argument, followed
+# by the tag, and the pre and post actions are the traversal's actions, so
+# they're also passed the tag's depth and path. Formatters keep everything
+# they need between actions in the PrintState, so prints can overlap.
+#
+# parameters
+# ----------
+#   tag:           the root tag to print
+#   maxdepth:      maximum depth level
+#   format:        a key in formatters
+#   out:           the file to print to, default is stdout
+#   path:          the names leading to tag, as in traverse_subtags
+#   sep:           the separators of printed norbert names
+#   lines:         the LineWriter to print to, instead of one for out
+def print_subtags(tag, maxdepth=DEFAULT_MAXDEPTH, format=DEFAULT_PRINTFORMAT,
+                  out=None, path=None, sep=DEFAULT_SEP, lines=None):
+    import functools
     (print_tag_init, print_tag_pre, print_tag_post, print_tag_done) = \
         formatters[format]
-    print_tag_init(tag)
-    traverse_subtags(tag, maxdepth=maxdepth,
-                     pre_action=print_tag_pre, post_action=print_tag_post)
-    print_tag_done(tag)
 
+    if lines is None and out is not None:
+        lines = LineWriter(out)
+    elif lines is None:
+        lines = output
+    state = PrintState(lines, sep)
 
+    try:
+        print_tag_init(state, tag)
+        traverse_subtags(tag, maxdepth=maxdepth,
+                         pre_action=functools.partial(print_tag_pre, state),
+                         post_action=functools.partial(print_tag_post, state),
+                         path=path)
+        print_tag_done(state, tag)
+    finally:
+        lines.flush()
+
+# the state of a single print_subtags() call
+#
+# output is the LineWriter that the formatter writes lines to, and sep the
+# separators of norbert names. Formatters add whatever else they keep
+# between actions in their init action.
+class PrintState(object):
+    def __init__(self, output, sep=DEFAULT_SEP):
+        self.output = output
+        self.sep = sep
 
-def human_print_init(tag):
-    tag.depth = 0
 
-def human_print_pre(tag):
-    if tag.id in complex_tag_types:
-        for child in tag.tags:
-            child.depth = tag.depth + 1
 
+def human_print_pre(state, tag, depth, path):
     if tag.name is None:
-        print('    ' * tag.depth + ": " + tag.valuestr())
+        state.output.write('%s: %s' % ('    ' * depth, tag.valuestr()))
     else:
-        print('    ' * tag.depth + tag.name + ": " + tag.valuestr())
+        state.output.write('%s%s: %s' % ('    ' * depth, tag.name,
+                                         tag.valuestr()))
 
-formatters["human"] = (human_print_init, human_print_pre, nothing, nothing)
+formatters["human"] = (nothing, human_print_pre, nothing, nothing)
 
 
 
-def nbt_txt_print_init(tag):
-    tag.depth = 0
-
-def nbt_txt_print_pre(tag):
-    if tag.id in complex_tag_types:
-        for child in tag.tags:
-            child.depth = tag.depth + 1
-
-    if tag.depth < 0:
-        return
-
+def nbt_txt_print_pre(state, tag, depth, path):
     if tag.id == nbt.TAG_COMPOUND:
-        value = str(len(tag.tags)) + " entries"
+        value = "%d entries" % len(tag.tags)
     elif tag.id == nbt.TAG_LIST:
-        value = str(len(tag.tags)) + " entries of type " + tag_types[tag.tagID]
-        for child in tag.tags:
-            child.name = None
+        value = "%d entries of type %s" % (len(tag.tags), tag_types[tag.tagID])
     elif tag.id == nbt.TAG_BYTE_ARRAY:
-        value = '[' + str(len(tag.value)) + " bytes]"
+        value = "[%d bytes]" % len(tag.value)
     elif tag.id == nbt.TAG_INT_ARRAY:
-        value = '[' + str(len(tag.value)) + " ints]"
+        value = "[%d ints]" % len(tag.value)
     else:
         value = tag.valuestr()
 
-    if tag.name is None:
-        print('   ' * tag.depth + tag_types[tag.id] + ": " + value)
+    indent = '   ' * depth
+    # elements of TAG_List's are printed without a name
+    if tag.name is None or (depth != 0 and isinstance(path[-1], int)):
+        state.output.write('%s%s: %s' % (indent, tag_types[tag.id], value))
     else:
-        print('   ' * tag.depth + tag_types[tag.id] + "(\"" + tag.name + \
-              "\"): " + value
-        )
+        state.output.write('%s%s("%s"): %s' % (indent, tag_types[tag.id],
+                                               tag.name, value))
 
     if tag.id in complex_tag_types:
-        print('   ' * tag.depth + '{')
+        state.output.write(indent + '{')
 
-def nbt_txt_print_post(tag):
+def nbt_txt_print_post(state, tag, depth, path):
     if tag.id in complex_tag_types:
-        print('   ' * tag.depth + '}')
+        state.output.write('   ' * depth + '}')
 
-formatters["nbt-txt"] = \
-    (nbt_txt_print_init, nbt_txt_print_pre, nbt_txt_print_post, nothing)
+formatters["nbt-txt"] = (nothing, nbt_txt_print_pre, nbt_txt_print_post, nothing)
 
 
 
-def norbert_print_init(tag):
-    tag.fullname = tag.name
+# Only tags with no children are printed, each with its full name. The full
+# names of the tags above the current one are kept by depth, so that each is
+# only joined once.
+def norbert_print_init(state, tag):
+    state.names = []
 
-def norbert_print_pre(tag):
-    sep = norbert_print_pre.sep
-    if tag.id in complex_tag_types and len(tag.tags) != 0:
-        for i, child in enumerate(tag.tags):
-            if tag.id == nbt.TAG_COMPOUND:
-                child.fullname = tag.fullname + sep[0] + child.name
-            elif tag.id == nbt.TAG_LIST:
-                child.fullname = tag.fullname + sep[1] + str(i)
+def norbert_print_pre(state, tag, depth, path):
+    sep = state.sep
+    if depth == 0 and len(path) == 1:
+        fullname = path[0] or ""
+    elif depth == 0:
+        # the path of a Query match, which starts below the root
+        fullname = norbert_join_name(path, sep)
     else:
-        if tag.id in [nbt.TAG_BYTE_ARRAY, nbt.TAG_INT_ARRAY]:
-            value = '(' + tag_types[tag.id] + ') ' + \
-                    ','.join(map(str, tag.value))
-        elif tag.id == nbt.TAG_LIST:
-            value = '(' + tag_types[tag.id] + ') ' + tag_types[tag.tagID]
+        parent = state.names[depth - 1]
+        name = path[-1]
+        if isinstance(name, int):
+            fullname = parent + sep[1] + str(name)
         else:
-            value = '(' + tag_types[tag.id] + ') ' \
-                    + codecs.getencoder("unicode_escape")(tag.valuestr())[0].decode("utf-8")
+            fullname = parent + sep[0] + name
 
-        print(tag.fullname + ' ' + sep[2] + ' ' + value)
+    if tag.id in complex_tag_types and len(tag.tags) != 0:
+        names = state.names
+        del names[depth:]
+        names.append(fullname)
+        return
+
+    if tag.id in [nbt.TAG_BYTE_ARRAY, nbt.TAG_INT_ARRAY]:
+        value = ','.join(map(str, tag.value))
+    elif tag.id == nbt.TAG_LIST:
+        value = tag_types[tag.tagID]
+    else:
+        value = norbert_escape(tag.valuestr())
 
-norbert_print_pre.sep = DEFAULT_SEP
+    state.output.write('%s %s (%s) %s' % (fullname, sep[2],
+                                          tag_types[tag.id], value))
 
 formatters["norbert"] = \
     (norbert_print_init, norbert_print_pre, nothing, nothing)
 
 
+# the binary formatter writes a tag as a named NBT tag, which makes a
+# complete NBT file if the tag is a TAG_Compound
+#
+# Tags are written in the order they are traversed, so nothing is held in
+# memory but the traversal's stack of ancestors of the current tag.
+
+def nbt_print_init(state, tag):
+    from . import stream
+    state.binary = BinaryWriter(state.output)
+    state.stream = stream
+
+def nbt_print_pre(state, tag, depth, path):
+    out = state.binary
+    stream = state.stream
+
+    # elements of TAG_List's have no header
+    if depth == 0:
+        out.write(stream.encode_header(tag.id, tag.name or ""))
+    elif not isinstance(path[-1], int):
+        out.write(stream.encode_header(tag.id, tag.name))
+
+    if tag.id == nbt.TAG_LIST:
+        tagid = tag.tagID
+        if tagid is None:
+            tagid = nbt.TAG_END
+        out.write(stream.encode_list_header(tagid, len(tag.tags)))
+    elif tag.id != nbt.TAG_COMPOUND:
+        tag._render_buffer(out)
+
+def nbt_print_post(state, tag, depth, path):
+    if tag.id == nbt.TAG_COMPOUND:
+        state.binary.write(b'\0')
+
+def nbt_print_done(state, tag):
+    state.binary.close()
+
+formatters["nbt"] = \
+    (nbt_print_init, nbt_print_pre, nbt_print_post, nbt_print_done)
+
+
+
+# the json formatter prints a tag as a JSON object with its type and value
+#
+#     {"name": "", "type": "TAG_Compound", "value": {
+#       "Pos": {"type": "TAG_List", "tagType": "TAG_Double", "value": [
+#         {"type": "TAG_Double", "value": 4.5},
+#       ...
+#
+# The value of a TAG_Compound is an object mapping the names of its children
+# to their own objects, and the value of a TAG_List is an array of its
+# children. Only the printed tag has a "name". Each line is written as soon
+# as the traversal reaches it.
+#
+# The ndjson formatter prints the same objects on one line each. If the
+# printed tag is a TAG_List, each of its children is printed as a line of its
+# own, otherwise the tag is printed as a single line.
+#
+# The output is strict JSON. A TAG_Float or TAG_Double that is NaN or
+# infinite has one of the strings in json_nonfinite as its value, which its
+# "type" tells the reader to turn back into a float.
+
+# returns: a function that encodes a value as strict JSON text
+def json_encoder():
+    import json
+    return json.JSONEncoder(allow_nan=False).encode
+
+json_close = {
+    nbt.TAG_COMPOUND: '}}',
+    nbt.TAG_LIST:     ']}'
+}
+
+# returns: the start of the JSON object of a tag, or all of it if the tag
+#          can't have children, with values encoded by encode
+def json_open(tag, withname, encode):
+    if withname and tag.name is not None:
+        text = '{"name": %s, "type": "%s", ' % (encode(tag.name),
+                                                 tag_types[tag.id])
+    else:
+        text = '{"type": "%s", ' % tag_types[tag.id]
+
+    if tag.id == nbt.TAG_COMPOUND:
+        return text + '"value": {'
+    elif tag.id == nbt.TAG_LIST:
+        tagid = tag.tagID
+        if tagid is None:
+            tagid = nbt.TAG_END
+        return text + '"tagType": "%s", "value": [' % tag_types[tagid]
+    elif tag.id in [nbt.TAG_BYTE_ARRAY, nbt.TAG_INT_ARRAY]:
+        return text + '"value": [%s]}' % ','.join(map(str, tag.value))
+    elif tag.id in [nbt.TAG_FLOAT, nbt.TAG_DOUBLE]:
+        name = json_nonfinite_name(tag.value)
+        if name is not None:
+            return text + '"value": "%s"}' % name
+    return text + '"value": %s}' % encode(tag.value)
+
+# returns: the key of json_nonfinite for a float that is NaN or infinite, or
+#          None if it's finite
+def json_nonfinite_name(value):
+    if value != value:
+        return "NaN"
+    elif value == json_nonfinite["Infinity"]:
+        return "Infinity"
+    elif value == json_nonfinite["-Infinity"]:
+        return "-Infinity"
+    return None
+
+# pushes a tag onto stack, a list of [tag, children seen, is last] entries
+# for the tag and its ancestors, encoding values with encode. The first tag
+# pushed gets a "name" if withname is True
+#
+# returns: the JSON text that starts the tag
+def json_enter(stack, tag, encode, withname=True):
+    if len(stack) == 0:
+        text = json_open(tag, withname, encode)
+        last = True
+    else:
+        parent = stack[-1]
+        parent[1] += 1
+        last = parent[1] == len(parent[0].tags)
+        text = json_open(tag, False, encode)
+        if parent[0].id == nbt.TAG_COMPOUND:
+            text = encode(tag.name) + ': ' + text
+
+    if tag.id not in complex_tag_types and not last:
+        text += ','
+
+    stack.append( [tag, 0, last] )
+    return text
+
+# pops a tag off stack
+#
+# returns: the JSON text that ends the tag, or None if json_enter() ended it
+def json_leave(stack):
+    (tag, seen, last) = stack.pop()
+    if tag.id not in complex_tag_types:
+        return None
+    elif last:
+        return json_close[tag.id]
+    else:
+        return json_close[tag.id] + ','
+
+def json_print_init(state, tag):
+    state.stack = []
+    state.encode = json_encoder()
+
+def json_print_pre(state, tag, depth, path):
+    state.output.write('  ' * depth + json_enter(state.stack, tag,
+                                                 state.encode))
+
+def json_print_post(state, tag, depth, path):
+    text = json_leave(state.stack)
+    if text is not None:
+        state.output.write('  ' * depth + text)
+
+formatters["json"] = (json_print_init, json_print_pre, json_print_post, nothing)
+
+def ndjson_print_init(state, tag):
+    state.stack = []
+    state.record = []
+    state.encode = json_encoder()
+    # the TAG_List whose children are printed, if any
+    if tag.id == nbt.TAG_LIST:
+        state.list = tag
+    else:
+        state.list = None
+
+def ndjson_print_pre(state, tag, depth, path):
+    if tag is state.list:
+        return
+    # children of the list have no name
+    text = json_enter(state.stack, tag, state.encode,
+                      withname=state.list is None)
+    state.record.append(text)
+
+def ndjson_print_post(state, tag, depth, path):
+    if tag is state.list:
+        return
+
+    stack = state.stack
+    record = state.record
+    text = json_leave(stack)
+    if text is not None:
+        record.append(text)
+    if len(stack) == 0:
+        state.output.write(''.join(record))
+        state.record = []
+
+formatters["ndjson"] = \
+    (ndjson_print_init, ndjson_print_pre, ndjson_print_post, nothing)
+
+
 
 if __name__ == "__main__":
     sys.exit(main())
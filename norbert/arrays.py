@@ -0,0 +1,148 @@
+#
+#   arrays.py - compact storage for NBT array tags
+#
+#   Copyright (C) 2012-2013 DMBuce <dmbuce@gmail.com>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with this program; if not, write to the Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import array
+import sys
+from struct import Struct
+from nbt import nbt
+
+# The payload of a TAG_Byte_Array is kept in a bytearray, and the payloads of
+# a TAG_Int_Array and a TAG_Long_Array in an array.array of 4 or 8 byte ints,
+# rather than in lists of int objects. Conversions to and from NBT data and
+# norbert text are done on the whole array at once.
+#
+# The TAG_Compound and TAG_List here parse their children with the classes
+# in TAGLIST instead of nbt's, so array tags anywhere in a file read with
+# NBTFile are compact.
+
+# typecodes of a 4 and an 8 byte signed int
+INT_TYPECODE = 'i' if array.array('i').itemsize == 4 else 'l'
+LONG_TYPECODE = 'q'
+
+int_format = Struct(">i")
+
+# returns: an array of ints decoded from big-endian NBT data
+def decode_ints(data, typecode=INT_TYPECODE):
+    values = array.array(typecode)
+    values.frombytes(data)
+    if sys.byteorder != "big":
+        values.byteswap()
+    return values
+
+# returns: big-endian NBT data encoded from a sequence of ints
+def encode_ints(values, typecode=INT_TYPECODE):
+    values = array.array(typecode, values)
+    if sys.byteorder != "big":
+        values.byteswap()
+    return values.tobytes()
+
+# parses a comma-delimited list of integers into the payload of a
+# TAG_Byte_Array
+#
+# Bytes may be given as signed (-128 to 127) or unsigned (0 to 255).
+#
+# raises: ValueError if a value isn't a byte
+def parse_bytes(value):
+    return bytes_from_ints(list(map(int, value.split(','))))
+
+# converts a list of ints into the payload of a TAG_Byte_Array, like
+# parse_bytes()
+def bytes_from_ints(values):
+    try:
+        return bytearray(values)
+    except ValueError:
+        pass
+
+    if min(values) < -128 or max(values) > 255:
+        raise ValueError("byte out of range")
+    return bytearray([ i & 0xff for i in values ])
+
+# parses a comma-delimited list of integers into the payload of a
+# TAG_Int_Array
+#
+# raises: ValueError if a value isn't a 4 byte int
+def parse_ints(value):
+    return ints_from_ints(map(int, value.split(',')))
+
+# converts a sequence of ints into the payload of a TAG_Int_Array, like
+# parse_ints()
+def ints_from_ints(values):
+    try:
+        return array.array(INT_TYPECODE, values)
+    except OverflowError:
+        raise ValueError("int out of range")
+
+# a TAG_Int_Array that is decoded and encoded with decode_ints() and
+# encode_ints()
+class TAG_Int_Array(nbt.TAG_Int_Array):
+    typecode = INT_TYPECODE
+
+    def _parse_buffer(self, buffer):
+        length = int_format.unpack(buffer.read(int_format.size))[0]
+        itemsize = array.array(self.typecode).itemsize
+        self.value = decode_ints(buffer.read(itemsize * length),
+                                 self.typecode)
+
+    def _render_buffer(self, buffer):
+        buffer.write(int_format.pack(len(self.value)))
+        buffer.write(encode_ints(self.value, self.typecode))
+
+# a TAG_Long_Array that is decoded and encoded like TAG_Int_Array
+class TAG_Long_Array(nbt.TAG_Long_Array):
+    typecode = LONG_TYPECODE
+    _parse_buffer = TAG_Int_Array._parse_buffer
+    _render_buffer = TAG_Int_Array._render_buffer
+
+# a TAG_Compound whose children are parsed with the classes in TAGLIST
+class TAG_Compound(nbt.TAG_Compound):
+    def _parse_buffer(self, buffer):
+        while True:
+            tagid = nbt.TAG_Byte(buffer=buffer).value
+            if tagid == nbt.TAG_END:
+                break
+            name = nbt.TAG_String(buffer=buffer).value
+            try:
+                tag = TAGLIST[tagid]()
+            except KeyError:
+                raise ValueError("Unrecognised tag type %d" % tagid)
+            tag.name = name
+            self.tags.append(tag)
+            tag._parse_buffer(buffer)
+
+# a TAG_List whose elements are parsed with the classes in TAGLIST
+class TAG_List(nbt.TAG_List):
+    def _parse_buffer(self, buffer):
+        self.tagID = nbt.TAG_Byte(buffer=buffer).value
+        self.tags = []
+        length = nbt.TAG_Int(buffer=buffer).value
+        cls = TAGLIST[self.tagID]
+        for i in range(length):
+            self.tags.append(cls(buffer=buffer))
+
+# an NBTFile whose tags are parsed with the classes in TAGLIST
+class NBTFile(nbt.NBTFile):
+    _parse_buffer = TAG_Compound._parse_buffer
+
+# classes to use for new tags, by tag type
+TAGLIST = dict(nbt.TAGLIST)
+TAGLIST[nbt.TAG_INT_ARRAY] = TAG_Int_Array
+TAGLIST[nbt.TAG_LONG_ARRAY] = TAG_Long_Array
+TAGLIST[nbt.TAG_COMPOUND] = TAG_Compound
+TAGLIST[nbt.TAG_LIST] = TAG_List
@@ -0,0 +1,133 @@
+#
+#   compress.py - gzip compression of NBT output, in parallel
+#
+#   Copyright (C) 2012-2013 DMBuce <dmbuce@gmail.com>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with this program; if not, write to the Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import collections
+import struct
+import time
+import zlib
+
+# Data written to a GzipWriter is collected into blocks of BLOCKSIZE bytes,
+# and each block is compressed as a raw deflate stream primed with the last
+# DICTSIZE bytes of the block before it, so that matches reach back across
+# the boundary as they would in a single stream. Every block but the last
+# ends with a sync flush, which ends the block on a byte boundary without
+# ending the stream, so the compressed blocks are written one after another
+# as a single gzip member, with a CRC and length computed over all the data.
+#
+# Since no block depends on another's compressed output, blocks can be
+# compressed by a pool of threads, and zlib lets go of the GIL while it
+# compresses. The output is the same for any number of threads. This is the
+# scheme pigz uses.
+#
+# Collecting blocks also means zlib is called once per block, instead of once
+# for each of the many small writes made while encoding a tree, which is
+# where most of the time spent writing through a gzip.GzipFile goes.
+
+BLOCKSIZE = 128 * 1024
+DICTSIZE = 32 * 1024
+
+# the gzip header's "extra flags" for the fastest and best compression levels
+XFL_FASTEST = 4
+XFL_BEST = 2
+# the gzip header's OS for "unknown", as written by the gzip module
+OS_UNKNOWN = 255
+
+class GzipWriter(object):
+    def __init__(self, fileobj, compresslevel=9, threads=1):
+        self.file = fileobj
+        self.compresslevel = compresslevel
+        self.buffer = bytearray()
+        # the data just before the current block
+        self.dictionary = b""
+        self.crc = 0
+        self.size = 0
+
+        # futures of the blocks being compressed, in order
+        self.pending = collections.deque()
+        self.pool = None
+        if threads > 1:
+            from concurrent.futures import ThreadPoolExecutor
+            self.pool = ThreadPoolExecutor(threads)
+            self.maxpending = 2 * threads
+
+        self.file.write(gzip_header(compresslevel))
+
+    def write(self, data):
+        self.buffer += data
+        if len(self.buffer) >= BLOCKSIZE:
+            self.compress(last=False)
+
+    def flush(self):
+        pass
+
+    # compresses the buffered data as a block, and writes out the blocks
+    # that are done, or all of them if it is the last
+    def compress(self, last):
+        block = bytes(self.buffer)
+        self.buffer = bytearray()
+        self.crc = zlib.crc32(block, self.crc)
+        self.size += len(block)
+        args = (block, self.dictionary, self.compresslevel, last)
+        self.dictionary = block[-DICTSIZE:]
+
+        if self.pool is None:
+            self.file.write(compress_block(*args))
+            return
+
+        self.pending.append(self.pool.submit(compress_block, *args))
+        while len(self.pending) > self.maxpending or \
+              (last and len(self.pending) != 0):
+            self.file.write(self.pending.popleft().result())
+
+    # writes the rest of the data and the gzip trailer, but doesn't close the
+    # underlying file
+    def close(self):
+        if self.file is None:
+            return
+        try:
+            self.compress(last=True)
+            self.file.write(struct.pack("<II", self.crc,
+                                        self.size & 0xffffffff))
+        finally:
+            if self.pool is not None:
+                self.pool.shutdown(cancel_futures=True)
+            self.file = None
+
+# returns: a gzip header, as written by the gzip module without a file name
+def gzip_header(compresslevel):
+    xfl = 0
+    if compresslevel == zlib.Z_BEST_COMPRESSION:
+        xfl = XFL_BEST
+    elif compresslevel == zlib.Z_BEST_SPEED:
+        xfl = XFL_FASTEST
+    return b'\x1f\x8b\x08\x00' + struct.pack("<IBB", int(time.time()), xfl,
+                                             OS_UNKNOWN)
+
+# returns: block as a raw deflate stream, primed with dictionary and ending
+#          with a sync flush, or ending the stream if last is True
+def compress_block(block, dictionary, compresslevel, last):
+    if len(dictionary) == 0:
+        c = zlib.compressobj(compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS)
+    else:
+        c = zlib.compressobj(compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS,
+                             zdict=dictionary)
+    if last:
+        return c.compress(block) + c.flush(zlib.Z_FINISH)
+    return c.compress(block) + c.flush(zlib.Z_SYNC_FLUSH)
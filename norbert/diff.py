@@ -0,0 +1,252 @@
+#
+#   diff.py - finding the tags that differ between two NBT files
+#
+#   Copyright (C) 2012-2013 DMBuce <dmbuce@gmail.com>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with this program; if not, write to the Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import io
+import itertools
+from struct import error as StructError
+from nbt import nbt
+from . import stream
+
+# Two NBT files are compared by walking their decompressed data in lockstep,
+# never building either tree. The payload of each tag is a contiguous span
+# of its file's data, so two tags with the same type and the same bytes in
+# their spans are the same tag, all the way down. Those are skipped with a
+# single comparison of the spans, made by bytes.startswith() without copying
+# either one. Only the children of tags that differ are looked at, so the
+# time taken by files that are mostly the same goes to finding where each
+# child's span ends, which is done by reading the lengths in its payload
+# straight from the data, without decoding anything else.
+#
+# Children of a TAG_Compound are matched by name and children of a TAG_List
+# by index, the same as their norbert names. A tag that is in only one file
+# is removed or added as a whole, and so is a tag whose type changed, or a
+# TAG_List whose element type changed. Any other leaf that differs is
+# changed, and is reported as removed then added.
+
+REMOVED = '-'
+ADDED = '+'
+
+# payload sizes of the tag types that have a fixed size
+fixed_sizes = dict( (tagid, fmt.size)
+                    for (tagid, fmt) in stream.fixed_formats.items() )
+
+list_header_format = stream.list_header_format
+ushort_unpack = stream.ushort_format.unpack_from
+int_unpack = stream.int_format.unpack_from
+list_header_unpack = list_header_format.unpack_from
+
+# the decompressed data of an NBT file
+#
+# A span is the (tagid, start, end) of a tag's payload in the data, where the
+# payload of a TAG_List starts with its element type and length. Spans are
+# found by skip_payload(), and tags are only decoded by load(), with an
+# EventReader.
+class Tree(object):
+    def __init__(self, data):
+        self.data = data
+        self.view = memoryview(data)
+        self.file = io.BytesIO(data)
+        self.reader = stream.EventReader(self.file)
+
+    # returns: (name, span) of the root tag
+    def root(self):
+        self.file.seek(0)
+        (tagid, name) = self.reader.read_root()
+        start = self.file.tell()
+        return (name, (tagid, start, skip_payload(self.data, start, tagid)))
+
+    # generates the (name, span) of each child of a TAG_Compound or
+    # TAG_List, where the name of an element of a TAG_List is its index
+    def children(self, span):
+        (tagid, pos, end) = span
+        data = self.data
+        try:
+            if tagid == nbt.TAG_COMPOUND:
+                while True:
+                    childtype = data[pos]
+                    if childtype == nbt.TAG_END:
+                        return
+                    length = stream.ushort_format.unpack_from(data, pos + 1)[0]
+                    pos += 3 + length
+                    name = data[pos - length : pos].decode("utf-8")
+                    start = pos
+                    pos = skip_payload(data, pos, childtype)
+                    yield (name, (childtype, start, pos))
+
+            (elemtype, length) = list_header_format.unpack_from(data, pos)
+            pos += list_header_format.size
+            if elemtype in stream.fixed_formats:
+                size = stream.fixed_formats[elemtype].size
+                for i in range(length):
+                    yield (i, (elemtype, pos, pos + size))
+                    pos += size
+                return
+
+            for i in range(length):
+                start = pos
+                pos = skip_payload(data, pos, elemtype)
+                yield (i, (elemtype, start, pos))
+        except (IndexError, StructError, UnicodeDecodeError) as e:
+            raise IOError("Malformed NBT data: " + str(e))
+
+    # returns: the element type of a TAG_List
+    def elemtype(self, span):
+        return self.data[span[1]]
+
+    # returns: True if a span of this tree has the same type and bytes as a
+    #          span of another
+    def same(self, span, other, otherspan):
+        (tagid, start, end) = span
+        (othertagid, otherstart, otherend) = otherspan
+        return tagid == othertagid and \
+               end - start == otherend - otherstart and \
+               self.data.startswith(other.view[otherstart : otherend], start)
+
+    # decodes the tag in a span into an nbt.TAG
+    def load(self, span):
+        self.file.seek(span[1])
+        return self.reader.read_payload(span[0])
+
+# skips the payload of a tag that starts at pos in data, like
+# EventReader.skip_payload(), but by reading lengths straight from the data
+# instead of from a file
+#
+# returns: the position just past the end of the payload
+# raises:  IOError if the payload is malformed or runs past the end of data
+def skip_payload(data, pos, tagid):
+    try:
+        end = skip(data, pos, tagid)
+    except (IndexError, StructError) as e:
+        raise IOError("Malformed NBT data: " + str(e))
+    if end > len(data):
+        raise IOError("Unexpected end of NBT data")
+    return end
+
+# the recursive part of skip_payload(), which leaves checking the end to it
+def skip(data, pos, tagid):
+    if tagid in fixed_sizes:
+        return pos + fixed_sizes[tagid]
+    elif tagid == nbt.TAG_STRING:
+        return pos + 2 + ushort_unpack(data, pos)[0]
+    elif tagid in stream.array_itemsizes:
+        length = int_unpack(data, pos)[0]
+        if length < 0:
+            raise IOError("Malformed NBT data: negative length")
+        return pos + 4 + stream.array_itemsizes[tagid] * length
+    elif tagid == nbt.TAG_LIST:
+        (elemtype, length) = list_header_unpack(data, pos)
+        pos += 5
+        if length < 0:
+            raise IOError("Malformed NBT data: negative length")
+        elif elemtype in fixed_sizes:
+            return pos + fixed_sizes[elemtype] * length
+        for i in range(length):
+            pos = skip(data, pos, elemtype)
+        return pos
+    elif tagid == nbt.TAG_COMPOUND:
+        while True:
+            childtype = data[pos]
+            if childtype == nbt.TAG_END:
+                return pos + 1
+            pos = skip(data, pos + 3 + ushort_unpack(data, pos + 1)[0],
+                       childtype)
+    else:
+        raise IOError("Unknown tag type: %s" % str(tagid))
+
+# generates a (sign, names, tag) triplet for each tag that is in only one
+# of two NBT files, where sign is REMOVED if the tag is only in old and ADDED
+# if it is only in new, names are the names leading to the tag from the
+# root, starting with the root's name, and tag is the tag as an nbt.TAG
+#
+# old and new are the decompressed data of the files, or None for a file
+# that doesn't exist, whose tags are all in the other. Nothing is generated
+# if they have the same tags.
+#
+# raises: IOError if either file is malformed
+def diff(old, new):
+    if old == new:
+        return
+    elif old is None:
+        yield whole_tree(ADDED, new)
+        return
+    elif new is None:
+        yield whole_tree(REMOVED, old)
+        return
+
+    trees = (Tree(old), Tree(new))
+    (oldname, oldspan) = trees[0].root()
+    (newname, newspan) = trees[1].root()
+    if oldname != newname:
+        yield (REMOVED, [oldname], trees[0].load(oldspan))
+        yield (ADDED, [newname], trees[1].load(newspan))
+        return
+
+    for triplet in diff_tags(trees, [oldname], oldspan, newspan):
+        yield triplet
+
+# returns: the triplet of diff() for the root tag of a file's data
+def whole_tree(sign, data):
+    tree = Tree(data)
+    (name, span) = tree.root()
+    return (sign, [name], tree.load(span))
+
+# generates the triplets of diff() for two tags that differ, given the names
+# leading to them and their spans in the old and new trees
+def diff_tags(trees, names, oldspan, newspan):
+    (old, new) = trees
+    tagid = oldspan[0]
+    if tagid != newspan[0] or \
+       tagid not in [nbt.TAG_COMPOUND, nbt.TAG_LIST] or \
+       (tagid == nbt.TAG_LIST and
+        old.elemtype(oldspan) != new.elemtype(newspan)):
+        yield (REMOVED, names, old.load(oldspan))
+        yield (ADDED, names, new.load(newspan))
+        return
+
+    if tagid == nbt.TAG_COMPOUND:
+        # the new tag's children are looked up by name
+        added = dict(new.children(newspan))
+        for (name, span) in old.children(oldspan):
+            newchild = added.pop(name, None)
+            if newchild is None:
+                yield (REMOVED, names + [name], old.load(span))
+            elif not old.same(span, new, newchild):
+                for triplet in diff_tags(trees, names + [name], span,
+                                         newchild):
+                    yield triplet
+        for (name, span) in added.items():
+            yield (ADDED, names + [name], new.load(span))
+        return
+
+    # elements of TAG_List's are compared in pairs, and the rest of the
+    # longer list is removed or added
+    pairs = itertools.zip_longest(old.children(oldspan),
+                                  new.children(newspan))
+    for (oldchild, newchild) in pairs:
+        if newchild is None:
+            (i, span) = oldchild
+            yield (REMOVED, names + [i], old.load(span))
+        elif oldchild is None:
+            (i, span) = newchild
+            yield (ADDED, names + [i], new.load(span))
+        elif not old.same(oldchild[1], new, newchild[1]):
+            for triplet in diff_tags(trees, names + [oldchild[0]],
+                                     oldchild[1], newchild[1]):
+                yield triplet
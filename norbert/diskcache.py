@@ -0,0 +1,290 @@
+#
+#   diskcache.py - an on-disk cache of decompressed, indexed NBT files
+#
+#   Copyright (C) 2012-2013 DMBuce <dmbuce@gmail.com>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with this program; if not, write to the Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import hashlib
+import io
+import json
+import mmap
+import os
+import tempfile
+import zlib
+from nbt import nbt
+from . import stream
+from .stream import EventReader, ENTER, LEAVE
+
+# Each NBT file in the cache has two entries in the cache directory, named
+# after a hash of the file's absolute path:
+#
+#   <hash>.nbt:  the file's NBT data, decompressed
+#   <hash>.idx:  an index of the tags in <hash>.nbt
+#
+# The first line of the index gives the path, size and mtime of the file it
+# was made from, and the entry is made again if they change. The rest of the
+# index is a line for each tag down to INDEX_DEPTH levels below the root,
+# sorted so that tags can be found by binary search on the mmap'd index
+# without reading all of it:
+#
+#   <names>\t<tagid> <offset> <length>
+#
+# where names is the JSON array of names and indexes leading to the tag,
+# offset is the position of its payload in <hash>.nbt and length is the
+# number of elements if it is a TAG_List. Tags deeper than INDEX_DEPTH are
+# found by reading from their deepest indexed ancestor.
+#
+# Entries are written to temporary files and renamed into place, index last.
+# Whenever an entry is used, its index is touched, and the least recently
+# used entries are removed until the cache is no bigger than its maximum
+# size.
+
+VERSION = "norbert-cache 1"
+INDEX_DEPTH = 2
+DEFAULT_MAXSIZE = 1024 * 1024 * 1024
+
+# returns: the line of the index that a list of names is found at
+def index_key(names):
+    return json.dumps(names, separators=(',', ':')).encode("ascii")
+
+class Cache(object):
+    def __init__(self, directory, maxsize=DEFAULT_MAXSIZE):
+        self.directory = directory
+        self.maxsize = maxsize
+
+    # returns: a CachedStream for an NBT file, making its entry if necessary
+    def open(self, filename):
+        filename = os.path.abspath(filename)
+        st = os.stat(filename)
+        header = "%s\t%s\t%d\t%d\n" % (VERSION, json.dumps(filename),
+                                       st.st_size, st.st_mtime_ns)
+        header = header.encode("utf-8")
+
+        stem = os.path.join(self.directory,
+                            hashlib.sha1(filename.encode("utf-8")).hexdigest())
+        try:
+            with open(stem + ".idx", 'rb') as f:
+                fresh = f.readline() == header
+        except IOError:
+            fresh = False
+
+        if fresh:
+            os.utime(stem + ".idx", None)
+        else:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            build_entry(filename, stem, header)
+        self.evict(keep=stem)
+
+        return CachedStream(filename, stem, len(header))
+
+    # removes the least recently used entries until the cache is no bigger
+    # than maxsize, except for the entry at stem
+    def evict(self, keep=None):
+        entries = []
+        total = 0
+        for name in os.listdir(self.directory):
+            if not name.endswith(".idx"):
+                continue
+            stem = os.path.join(self.directory, name[:-len(".idx")])
+            try:
+                size = os.path.getsize(stem + ".idx") + \
+                       os.path.getsize(stem + ".nbt")
+                used = os.path.getmtime(stem + ".idx")
+            except OSError:
+                continue
+            entries.append( (used, stem, size) )
+            total += size
+
+        entries.sort()
+        for (used, stem, size) in entries:
+            if total <= self.maxsize:
+                break
+            if stem == keep:
+                continue
+            for ext in [".idx", ".nbt"]:
+                try:
+                    os.remove(stem + ext)
+                except OSError:
+                    pass
+            total -= size
+
+# decompresses an NBT file into stem.nbt and indexes it into stem.idx
+def build_entry(filename, stem, header):
+    f = stream.open_file(filename)
+    try:
+        data = f.read()
+    except (EOFError, IOError, zlib.error) as e:
+        raise IOError("Corrupt NBT data: " + str(e))
+    finally:
+        f.close()
+
+    lines = index_tags(data)
+    directory = os.path.dirname(stem)
+    for (ext, write) in [ (".nbt", lambda f: f.write(data)),
+                          (".idx", lambda f: write_index(f, header, lines)) ]:
+        (fd, tmp) = tempfile.mkstemp(dir=directory, prefix=".tmp")
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                write(f)
+            os.rename(tmp, stem + ext)
+        except:
+            os.remove(tmp)
+            raise
+
+def write_index(f, header, lines):
+    f.write(header)
+    for (key, tagid, offset, length) in lines:
+        f.write(b"%s\t%d %d %d\n" % (key, tagid, offset, length))
+
+# returns: a sorted list of (key, tagid, offset, length) for the tags in
+#          data down to INDEX_DEPTH
+def index_tags(data):
+    f = io.BytesIO(data)
+    reader = EventReader(f)
+    lines = {}
+    # names of the TAG_Compound's and TAG_List's entered below the root, or
+    # None until the root is entered
+    names = None
+    for (event, tagid, name, info) in reader.events():
+        if event == LEAVE:
+            if len(names) != 0:
+                names.pop()
+            continue
+
+        offset = f.tell()
+        length = 0
+        if tagid == nbt.TAG_LIST:
+            # the list header is part of the payload
+            offset -= stream.list_header_format.size
+            length = info[1]
+
+        if names is None:
+            names = []
+            path = names
+        else:
+            path = names + [name]
+
+        key = index_key(path)
+        if key not in lines:
+            lines[key] = (key, tagid, offset, length)
+
+        if event == ENTER and path is not names:
+            if len(path) == INDEX_DEPTH:
+                reader.skip()
+            else:
+                names.append(name)
+
+    return sorted(lines.values())
+
+# an NBT file in the cache
+#
+# Like stream.NBTStream, tags are found each time get_tag() is called. But
+# they are found by looking them up in the index, then reading the
+# decompressed data from where the tag, or its deepest indexed ancestor, is.
+class CachedStream(stream.NBTStream):
+    def __init__(self, filename, stem, start):
+        stream.NBTStream.__init__(self, filename)
+        with open(stem + ".idx", 'rb') as f:
+            self.index = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        with open(stem + ".nbt", 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        # position of the first line after the header
+        self.start = start
+
+        self.data.seek(0)
+        (tagid, self.rootname) = EventReader(self.data).read_root()
+
+    # returns: (tagid, offset, length) of the tag with the given names, or
+    #          None if it isn't in the index
+    def lookup(self, names):
+        key = index_key(names)
+        lo = self.start
+        hi = len(self.index)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            linestart = self.index.rfind(b'\n', lo, mid) + 1
+            if linestart == 0:
+                linestart = lo
+            lineend = self.index.find(b'\n', linestart)
+            (linekey, found, fields) = \
+                self.index[linestart:lineend].partition(b'\t')
+            if key == linekey:
+                return tuple(map(int, fields.split()))
+            elif key < linekey:
+                hi = linestart
+            else:
+                lo = lineend + 1
+        return None
+
+    # reads up to a tag like stream.seek_tag()
+    #
+    # returns: (reader, (tagid, name, info)) with reader at the start of the
+    #          tag's payload, or None if there is no such tag
+    def seek_tag(self, names):
+        found = []
+        (tagid, offset, length) = self.lookup(found)
+        while len(found) < len(names) and len(found) < INDEX_DEPTH:
+            wanted = names[len(found)]
+            if tagid == nbt.TAG_LIST:
+                try:
+                    wanted = int(wanted)
+                except ValueError:
+                    return None
+                if wanted < 0:
+                    wanted += length
+            elif tagid != nbt.TAG_COMPOUND or isinstance(wanted, int):
+                return None
+
+            entry = self.lookup(found + [wanted])
+            if entry is None:
+                return None
+            found.append(wanted)
+            (tagid, offset, length) = entry
+
+        if len(found) == 0:
+            name = self.rootname
+        else:
+            name = found[-1]
+
+        self.data.seek(offset)
+        reader = EventReader(self.data)
+        tag = stream.seek_tag(reader, names[len(found):], root=(tagid, name))
+        if tag is None:
+            return None
+        return (reader, tag)
+
+    def root_name(self):
+        return self.rootname
+
+    def get_tag(self, names):
+        found = self.seek_tag(names)
+        if found is None:
+            return None
+        (reader, (tagid, name, info)) = found
+        return stream.load_tag(reader, tagid, name)
+
+    def copy_tag(self, names, out):
+        found = self.seek_tag(names)
+        if found is None:
+            return False
+        (reader, (tagid, name, info)) = found
+        if isinstance(name, int):
+            name = ""
+        out.write(stream.encode_header(tagid, name))
+        reader.copy(out)
+        return True
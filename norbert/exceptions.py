@@ -8,6 +8,10 @@ TAG_CONVERSION_ERROR = 6
 INVALID_VALUE = 7
 INVALID_TYPE = 8
 
+# exit statuses of -D, which are those of diff(1)
+FILES_DIFFER = 1
+DIFF_TROUBLE = 2
+
 class Error(Exception):
     """Base class for exceptions in the norbert module."""
     def __init__(self, value):
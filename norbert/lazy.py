@@ -0,0 +1,289 @@
+#
+#   lazy.py - NBT trees that are decoded on demand
+#
+#   Copyright (C) 2012-2013 DMBuce <dmbuce@gmail.com>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with this program; if not, write to the Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import io
+import mmap
+import shutil
+import tempfile
+import zlib
+from nbt import nbt
+from . import arrays
+from .stream import EventReader, open_file, COPY_BLOCKSIZE
+
+# A TAG_Compound or TAG_List only remembers where its payload is in data
+# until its tags are first accessed. Then its children are decoded, with
+# their own TAG_Compound's and TAG_List's left undecoded in the same way.
+#
+# A tag whose tags have never been accessed can't have been modified, so it
+# is written by copying its payload from data.
+#
+# If LazyList.window is set, the elements of a TAG_List longer than it are
+# never all decoded at once. Its tags are a WindowedList, which decodes
+# window elements at a time as they are reached and drops the ones before.
+# data is then an mmap of the decompressed file, so that it doesn't have to
+# be held in memory either.
+class LazyTag(object):
+    def init_lazy(self, data, start, end):
+        self.data = data
+        self.start = start
+        self.end = end
+        self.lazytags = None
+
+    # decodes the children with read_children(), which each subclass defines
+    def get_tags(self):
+        if self.lazytags is None:
+            self.lazytags = self.read_children(self.reader())
+        return self.lazytags
+
+    def set_tags(self, tags):
+        self.lazytags = tags
+
+    tags = property(get_tags, set_tags)
+
+    # returns an EventReader positioned at the start of the tag's payload
+    #
+    # An mmap is read from directly. Each reader seeks it before it's used,
+    # and is done with it before any other reader is.
+    def reader(self):
+        if isinstance(self.data, mmap.mmap):
+            f = self.data
+        else:
+            f = io.BytesIO(self.data)
+        f.seek(self.start)
+        return EventReader(f)
+
+    # True if the tag might have been modified
+    def is_modified(self):
+        return self.lazytags is not None
+
+    def _render_buffer(self, buffer):
+        if not self.is_modified():
+            for pos in range(self.start, self.end, COPY_BLOCKSIZE):
+                buffer.write(self.data[pos:min(pos + COPY_BLOCKSIZE,
+                                               self.end)])
+        else:
+            super(LazyTag, self)._render_buffer(buffer)
+
+class LazyCompound(LazyTag, nbt.TAG_Compound):
+    def __init__(self, data, start, end, name=None):
+        nbt.TAG_Compound.__init__(self, name=name)
+        self.init_lazy(data, start, end)
+
+    def read_children(self, reader):
+        return read_compound(reader, self.data)
+
+class LazyList(LazyTag, nbt.TAG_List):
+    # the most elements decoded at a time, or None to decode them all
+    window = None
+
+    def __init__(self, data, start, end, info, name=None):
+        nbt.TAG_List.__init__(self, name=name)
+        self.init_lazy(data, start, end)
+        (self.tagID, self.length) = info
+        self.windowed = None
+
+    def get_tags(self):
+        if self.lazytags is None and self.window is not None and \
+           self.length > self.window:
+            if self.windowed is None:
+                self.windowed = WindowedList(self, self.window)
+            return self.windowed
+        return LazyTag.get_tags(self)
+
+    tags = property(get_tags, LazyTag.set_tags)
+
+    def is_modified(self):
+        return self.lazytags is not None or \
+               (self.windowed is not None and len(self.windowed.pinned) != 0)
+
+    def read_children(self, reader):
+        (tagid, length) = reader.read_list_header()
+        return [ read_tag(reader, self.data, tagid, None)
+                 for i in range(length) ]
+
+    # the length is known without decoding the children
+    def __len__(self):
+        if self.lazytags is None:
+            return self.length
+        return len(self.lazytags)
+
+    def valuestr(self):
+        return "[%i %s(s)]" % (len(self), nbt.TAGLIST[self.tagID].__name__)
+
+# the elements of a LazyList, decoded a window at a time
+#
+# Elements are decoded in order, so going through them from first to last
+# decodes each one once. Going back to an element before the window starts
+# over from the beginning of the list.
+#
+# An element returned by pin() is kept for as long as the list is, since it
+# may be modified, and is given out in place of the one in data from then
+# on. Anything that adds or removes elements first decodes all of them into
+# the list's tags, like an ordinary LazyList.
+class WindowedList(object):
+    def __init__(self, owner, size):
+        self.owner = owner
+        self.size = size
+        self.pinned = {}
+        # decoded elements, starting with element number base
+        self.base = 0
+        self.window = []
+        # number and position in data of the element after the window
+        self.next = 0
+        self.offset = None
+
+    def __len__(self):
+        return self.owner.length
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [ self[j] for j in range(*i.indices(len(self))) ]
+        i = self.position(i)
+        if i in self.pinned:
+            return self.pinned[i]
+        if not self.base <= i < self.base + len(self.window):
+            self.slide(i)
+        return self.window[i - self.base]
+
+    # returns: element i, which is kept from now on
+    def pin(self, i):
+        i = self.position(i)
+        if i not in self.pinned:
+            self.pinned[i] = self[i]
+        return self.pinned[i]
+
+    # returns: i as a non-negative index
+    # raises:  IndexError if there is no element i
+    def position(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("list index out of range")
+        return i
+
+    # decodes the window of elements starting at element i
+    def slide(self, i):
+        self.window = []
+        reader = self.owner.reader()
+        if self.offset is None or i < self.next:
+            (tagid, length) = reader.read_list_header()
+            self.next = 0
+        else:
+            reader.file.seek(self.offset)
+
+        tagid = self.owner.tagID
+        while self.next < i:
+            reader.skip_payload(tagid)
+            self.next += 1
+
+        self.base = i
+        data = self.owner.data
+        while self.next < len(self) and len(self.window) < self.size:
+            self.window.append(read_tag(reader, data, tagid, None))
+            self.next += 1
+        self.offset = reader.file.tell()
+
+    # returns: a list of every element, which becomes the owner's tags
+    def load(self):
+        tags = list(self)
+        self.owner.tags = tags
+        self.owner.windowed = None
+        return tags
+
+    def __setitem__(self, i, tag):
+        self.load()[i] = tag
+
+    def __delitem__(self, i):
+        del self.load()[i]
+
+    def insert(self, i, tag):
+        self.load().insert(i, tag)
+
+    def append(self, tag):
+        self.load().append(tag)
+
+# reads the children of a TAG_Compound from reader, which reads from data
+def read_compound(reader, data):
+    tags = []
+    while True:
+        tagid = reader.read_byte()
+        if tagid == nbt.TAG_END:
+            break
+        name = reader.read_string()
+        tags.append(read_tag(reader, data, tagid, name))
+    return tags
+
+# reads the payload of a tag from reader, which reads from data, leaving
+# TAG_Compound's and TAG_List's undecoded
+def read_tag(reader, data, tagid, name):
+    start = reader.file.tell()
+    if tagid == nbt.TAG_COMPOUND:
+        reader.skip_payload(tagid)
+        tag = LazyCompound(data, start, reader.file.tell(), name)
+    elif tagid == nbt.TAG_LIST:
+        info = reader.read_list_header()
+        reader.skip_payload(tagid, info)
+        tag = LazyList(data, start, reader.file.tell(), info, name)
+    elif tagid in nbt.TAGLIST and tagid != nbt.TAG_END:
+        tag = arrays.TAGLIST[tagid]()
+        tag.value = reader.read_value(tagid)
+        tag.name = name
+    else:
+        raise IOError("Unknown tag type: %s" % str(tagid))
+
+    return tag
+
+# reads an NBT file, decoding only the top-level tags
+#
+# If LazyList.window is set, the file is decompressed into a temporary file
+# that is mmap'd instead of being read into memory.
+def read_file(filename):
+    f = open_file(filename)
+    try:
+        if LazyList.window is None:
+            data = f.read()
+        else:
+            data = map_file(f)
+    except (EOFError, zlib.error) as e:
+        raise IOError("Corrupt NBT data: " + str(e))
+    finally:
+        f.close()
+
+    nbtfile = nbt.NBTFile()
+    if isinstance(data, mmap.mmap):
+        reader = EventReader(data)
+    else:
+        reader = EventReader(io.BytesIO(data))
+    (tagid, nbtfile.name) = reader.read_root()
+    nbtfile.tags = read_compound(reader, data)
+    return nbtfile
+
+# returns: a read-only mmap of the rest of f, copied to a temporary file
+def map_file(f):
+    with tempfile.TemporaryFile() as tmp:
+        shutil.copyfileobj(f, tmp, COPY_BLOCKSIZE)
+        tmp.flush()
+        if tmp.tell() == 0:
+            raise IOError("Unexpected end of NBT data")
+        return mmap.mmap(tmp.fileno(), 0, access=mmap.ACCESS_READ)
@@ -0,0 +1,74 @@
+#
+#   patch.py - reading unified diffs
+#
+#   Copyright (C) 2012-2013 DMBuce <dmbuce@gmail.com>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with this program; if not, write to the Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import re
+
+# the start of a hunk, e.g. "@@ -12,3 +12,4 @@". A missing count is 1
+hunk_header = re.compile(r'^@@ -\d+(?:,(\d+))? \+\d+(?:,(\d+))? @@')
+
+# reads the lines removed and added by a unified diff, such as the output of
+# diff -u
+#
+# Only the hunks are read. Anything outside of them, like the names of the
+# files that were compared, is ignored. Context lines are skipped over using
+# the line counts in each hunk's header.
+#
+# returns: (removed, added), lists of lines without their "-" or "+" prefix
+#          or newline, in the order they appear in the diff
+# raises:  IOError if a hunk is malformed
+def read_diff(f):
+    removed = []
+    added = []
+    # lines left in the current hunk from the old and new files
+    old = 0
+    new = 0
+
+    for line in f:
+        line = line.rstrip('\n')
+        if old == 0 and new == 0:
+            if line.startswith('@@'):
+                match = hunk_header.match(line)
+                if match is None:
+                    raise IOError("Malformed hunk header: " + line)
+                (old, new) = [ 1 if count is None else int(count)
+                               for count in match.groups() ]
+            continue
+
+        if line.startswith('-'):
+            removed.append(line[1:])
+            old -= 1
+        elif line.startswith('+'):
+            added.append(line[1:])
+            new -= 1
+        elif line.startswith('\\'):
+            # "\ No newline at end of file"
+            continue
+        else:
+            # context, which some tools strip down to "" if it was blank
+            old -= 1
+            new -= 1
+
+        if old < 0 or new < 0:
+            raise IOError("Malformed hunk: too many lines")
+
+    if old != 0 or new != 0:
+        raise IOError("Malformed hunk: unexpected end of diff")
+
+    return (removed, added)
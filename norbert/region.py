@@ -0,0 +1,157 @@
+#
+#   region.py - reading and writing chunks in region files
+#
+#   Copyright (C) 2012-2013 DMBuce <dmbuce@gmail.com>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with this program; if not, write to the Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import gzip
+import io
+import mmap
+import time
+import zlib
+from struct import Struct
+
+# A region file (.mcr or .mca) holds the NBT data of 32x32 chunks. It starts
+# with a table of the location of each chunk, followed by a table of the time
+# each chunk was last written. The rest of the file is divided into sectors,
+# and each chunk takes up one or more consecutive sectors.
+SECTOR_SIZE = 4096
+CHUNKS = 1024
+HEADER_SIZE = 2 * SECTOR_SIZE
+
+# compression schemes of chunk data
+COMPRESSION_GZIP = 1
+COMPRESSION_ZLIB = 2
+COMPRESSION_NONE = 3
+
+uint_format = Struct(">I")
+chunk_header_format = Struct(">IB")
+
+# returns the x, z coordinates of a chunk within its region
+def chunk_coords(index):
+    return (index % 32, index // 32)
+
+class RegionFile(object):
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = open(filename, 'rb')
+        try:
+            self.map = mmap.mmap(self.file.fileno(), 0,
+                                 access=mmap.ACCESS_READ)
+        except ValueError:
+            # the file is empty
+            self.file.close()
+            raise IOError("Not a region file")
+
+        if len(self.map) < HEADER_SIZE:
+            self.close()
+            raise IOError("Not a region file")
+
+        # (sector offset, sector count) of each chunk
+        self.locations = []
+        for i in range(CHUNKS):
+            location = uint_format.unpack_from(self.map, 4 * i)[0]
+            self.locations.append( (location >> 8, location & 0xff) )
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+    # returns the indexes of the chunks that exist in the file
+    def chunks(self):
+        return [ i for i, (offset, count) in enumerate(self.locations)
+                 if offset != 0 and count != 0 ]
+
+    # returns the decompressed NBT data of a chunk
+    def read_chunk(self, index):
+        chunk = self.raw_chunk(index)
+        if chunk is None:
+            raise IOError("Chunk %d,%d is not in the file" %
+                          chunk_coords(index))
+        return decompress_chunk(index, *chunk)
+
+    # returns (compression, data) of a chunk as it is stored in the file, or
+    # None if the chunk doesn't exist
+    def raw_chunk(self, index):
+        (offset, count) = self.locations[index]
+        start = offset * SECTOR_SIZE
+        if offset < 2 or start + chunk_header_format.size > len(self.map):
+            return None
+
+        (length, compression) = chunk_header_format.unpack_from(self.map,
+                                                                 start)
+        start += chunk_header_format.size
+        data = self.map[start : start + length - 1]
+        if len(data) != length - 1:
+            raise IOError("Chunk %d,%d is truncated" % chunk_coords(index))
+
+        return (compression, data)
+
+# returns the decompressed NBT data of a chunk, given the compression type and
+# data from RegionFile.raw_chunk()
+def decompress_chunk(index, compression, data):
+    try:
+        if compression == COMPRESSION_ZLIB:
+            return zlib.decompress(data)
+        elif compression == COMPRESSION_GZIP:
+            return gzip.GzipFile(fileobj=io.BytesIO(data)).read()
+        elif compression == COMPRESSION_NONE:
+            return data
+    except (EOFError, zlib.error) as e:
+        raise IOError("Chunk %d,%d is corrupt: %s" %
+                      (chunk_coords(index) + (str(e),)))
+
+    raise IOError("Chunk %d,%d has unknown compression type %d" %
+                  (chunk_coords(index) + (compression,)))
+
+# writes chunks to a region file, given as a file object opened for reading
+# and writing, such as a copy of the file being changed
+#
+# chunks is a dict mapping chunk indexes to their uncompressed NBT data. Only
+# those chunks are written. A chunk is written over its old sectors if it
+# fits in them, otherwise it is moved to the end of the file.
+def write_chunks(f, chunks):
+    f.seek(0)
+    header = bytearray(f.read(HEADER_SIZE))
+    f.seek(0, io.SEEK_END)
+    end = (f.tell() + SECTOR_SIZE - 1) // SECTOR_SIZE
+    now = int(time.time())
+
+    for index in sorted(chunks):
+        data = zlib.compress(chunks[index])
+        data = chunk_header_format.pack(len(data) + 1,
+                                        COMPRESSION_ZLIB) + data
+        count = (len(data) + SECTOR_SIZE - 1) // SECTOR_SIZE
+        if count > 0xff:
+            raise IOError("Chunk %d,%d is too large" %
+                          chunk_coords(index))
+
+        location = uint_format.unpack_from(header, 4 * index)[0]
+        (offset, oldcount) = (location >> 8, location & 0xff)
+        if offset < 2 or count > oldcount:
+            offset = end
+            end += count
+
+        f.seek(offset * SECTOR_SIZE)
+        f.write(data)
+        f.write(b'\0' * (count * SECTOR_SIZE - len(data)))
+
+        uint_format.pack_into(header, 4 * index, (offset << 8) | count)
+        uint_format.pack_into(header, SECTOR_SIZE + 4 * index, now)
+
+    f.seek(0)
+    f.write(header)
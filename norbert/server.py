@@ -0,0 +1,194 @@
+#
+#   server.py - running norbert invocations in a long-lived process
+#
+#   Copyright (C) 2012-2013 DMBuce <dmbuce@gmail.com>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with this program; if not, write to the Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import errno
+import os
+import signal
+import socket
+import sys
+import traceback
+
+# A client runs an invocation of norbert on the server by connecting to its
+# UNIX socket and sending:
+#
+#   1. a single byte, sent along with its stdin, stdout and stderr file
+#      descriptors
+#   2. its working directory and arguments, each followed by a NUL byte
+#
+# then shutting down its end of the connection for writing. The server forks
+# a process for each connection, which takes on the client's file
+# descriptors and working directory, runs main() with the client's
+# arguments, and replies with the exit status as a decimal number. Since
+# each invocation has a fresh fork of the server, nothing one invocation
+# changes is seen by the next.
+#
+# The client side is in norbert.py, which uses the server given by the
+# NORBERT_SOCKET environment variable, so that it doesn't have to load the
+# rest of norbert.
+
+# the most bytes of working directory and arguments accepted from a client
+MAX_REQUEST = 1024 * 1024
+
+# listens on a UNIX socket at path and runs invocations sent to it until
+# interrupted
+#
+# returns: an exit status
+# raises:  IOError if the socket can't be made
+def serve(path):
+    from . import main
+    warm_up()
+
+    listener = listen(path)
+    # children are reaped automatically
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        while True:
+            try:
+                (conn, addr) = listener.accept()
+            except InterruptedError:
+                continue
+
+            if os.fork() == 0:
+                listener.close()
+                signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                status = 1
+                try:
+                    status = handle(conn, main)
+                except BaseException:
+                    traceback.print_exc()
+                finally:
+                    os._exit(status)
+            conn.close()
+    except KeyboardInterrupt:
+        return 0
+    finally:
+        listener.close()
+        os.remove(path)
+
+# modules that are only imported when they're needed
+WARM_MODULES = [
+    "copy", "functools", "json", "multiprocessing", "operator", "optparse",
+    "re", "shutil", "tempfile", "zlib",
+    ".arrays", ".compress", ".diff", ".diskcache", ".lazy", ".patch",
+    ".region", ".stats", ".stream",
+]
+
+# imports WARM_MODULES, so that invocations don't have to
+def warm_up():
+    import importlib
+    for name in WARM_MODULES:
+        importlib.import_module(name, __package__)
+
+# returns: a socket listening at path, that only this user can connect to
+# raises:  IOError if the socket can't be made, or another server is already
+#          listening at path
+def listen(path):
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    umask = os.umask(0o077)
+    try:
+        try:
+            listener.bind(path)
+        except OSError as e:
+            if e.errno != errno.EADDRINUSE or is_listening(path):
+                raise
+            # left behind by a server that's gone
+            os.remove(path)
+            listener.bind(path)
+    except OSError as e:
+        listener.close()
+        raise IOError(e.errno, "Can't listen on '%s': %s" %
+                               (path, e.strerror))
+    finally:
+        os.umask(umask)
+
+    listener.listen(socket.SOMAXCONN)
+    return listener
+
+def is_listening(path):
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(path)
+        return True
+    except OSError:
+        return False
+    finally:
+        s.close()
+
+# runs the invocation sent over conn, in a forked process
+#
+# returns: an exit status for the process
+def handle(conn, main):
+    try:
+        (data, fds, flags, addr) = socket.recv_fds(conn, 1, 3)
+        if len(fds) != 3:
+            return 1
+        request = b""
+        while len(request) <= MAX_REQUEST:
+            data = conn.recv(65536)
+            if data == b"":
+                break
+            request += data
+    except OSError:
+        return 1
+
+    fields = request.split(b'\0')
+    if len(fields) < 2 or fields[-1] != b"" or len(request) > MAX_REQUEST:
+        return 1
+    (cwd, args) = (fields[0], fields[1:-1])
+
+    # take on the client's stdio and working directory
+    for f in [sys.stdout, sys.stderr]:
+        f.flush()
+    for (fd, clientfd) in enumerate(fds):
+        os.dup2(clientfd, fd)
+        os.close(clientfd)
+    try:
+        os.chdir(cwd)
+    except OSError as e:
+        sys.stderr.write("Can't change directory: %s\n" % e.strerror)
+        reply(conn, 1)
+        return 0
+    sys.argv = ["norbert"] + [ os.fsdecode(arg) for arg in args ]
+
+    try:
+        status = main()
+    except SystemExit as e:
+        # optparse exits after --help and --version, and on bad options
+        if e.code is None:
+            status = 0
+        elif isinstance(e.code, int):
+            status = e.code
+        else:
+            sys.stderr.write(str(e.code) + '\n')
+            status = 1
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+    reply(conn, status)
+    return 0
+
+def reply(conn, status):
+    try:
+        conn.sendall(b"%d\n" % (status or 0))
+    except OSError:
+        pass
@@ -0,0 +1,245 @@
+#
+#   stats.py - timing and resource usage of a norbert run
+#
+#   Copyright (C) 2012-2013 DMBuce <dmbuce@gmail.com>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with this program; if not, write to the Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import contextlib
+import time
+from nbt import nbt
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Stats are kept in three parts:
+#
+#   phases:    wall and CPU seconds spent in each phase of the run, such as
+#              reading the input file or printing tags. A phase started
+#              inside another is named after both, e.g. "read/parse"
+#   counters:  counts of tags, lines and bytes
+#   actions:   if profiling, the number of calls to each formatter action
+#              for each tag type, how long they took, and a histogram of
+#              their durations
+#
+# Nothing is recorded until enable() is called, so the hooks into norbert
+# cost next to nothing when stats aren't wanted.
+
+class Stats(object):
+    def __init__(self):
+        self.enabled = False
+        self.profiling = False
+        self.phases = {}
+        self.order = []
+        self.current = []
+        self.counters = {}
+        self.actions = {}
+        self.start = None
+        self.children = 0.0
+
+    def enable(self, profile=False):
+        self.enabled = True
+        self.profiling = profile
+        self.start = (time.perf_counter(), time.process_time())
+        self.children = children_cpu()
+
+    # times everything done inside a with statement as the named phase
+    #
+    # Time spent in a phase more than once is added up.
+    @contextlib.contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+            return
+
+        self.current.append(name)
+        name = "/".join(self.current)
+        if name not in self.phases:
+            self.phases[name] = [0.0, 0.0]
+            self.order.append(name)
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - wall
+            cpu = time.process_time() - cpu
+            self.current.pop()
+            self.phases[name][0] += wall
+            self.phases[name][1] += cpu
+
+    def count(self, name, n=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    # wraps the pre and post actions of a traversal
+    #
+    # The wrapped pre action counts the tags visited. If profiling, both
+    # actions are also timed by tag type.
+    #
+    # returns: (pre_action, post_action)
+    def wrap_actions(self, pre_action, post_action):
+        if not self.enabled:
+            return (pre_action, post_action)
+
+        if not self.profiling:
+            def counted_pre(tag, depth, path):
+                self.counters["tags visited"] = \
+                    self.counters.get("tags visited", 0) + 1
+                pre_action(tag, depth, path)
+            return (counted_pre, post_action)
+
+        timed_pre = self.timed_action(pre_action, "pre")
+        timed_post = self.timed_action(post_action, "post")
+        def counted_pre(tag, depth, path):
+            self.counters["tags visited"] = \
+                self.counters.get("tags visited", 0) + 1
+            timed_pre(tag, depth, path)
+        return (counted_pre, timed_post)
+
+    # returns: action, recording how long each call takes in self.actions
+    def timed_action(self, action, kind):
+        actions = self.actions
+        clock = time.perf_counter
+        def timed(tag, depth, path):
+            start = clock()
+            action(tag, depth, path)
+            seconds = clock() - start
+
+            key = (tag.id, kind)
+            if key not in actions:
+                actions[key] = [0, 0.0, {}]
+            entry = actions[key]
+            entry[0] += 1
+            entry[1] += seconds
+            # bucket b holds calls that took less than 2**b microseconds,
+            # but at least 2**(b-1)
+            bucket = int(seconds * 1e6).bit_length()
+            entry[2][bucket] = entry[2].get(bucket, 0) + 1
+        return timed
+
+    # returns: the stats as a dict that can be dumped as JSON
+    def summary(self):
+        wall = time.perf_counter() - self.start[0]
+        cpu = time.process_time() - self.start[1]
+        phases = dict( (name, {"wall": w, "cpu": c})
+                       for (name, (w, c)) in self.phases.items() )
+        phases["total"] = {"wall": wall, "cpu": cpu}
+
+        summary = {
+            "phases": phases,
+            "counters": dict(self.counters),
+        }
+
+        if resource is not None:
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            children = resource.getrusage(resource.RUSAGE_CHILDREN)
+            # ru_maxrss is in kilobytes on Linux
+            summary["peak_rss_kb"] = usage.ru_maxrss
+            summary["children"] = {
+                "cpu": children_cpu() - self.children,
+                "peak_rss_kb": children.ru_maxrss,
+            }
+
+        if self.profiling:
+            actions = {}
+            for ((tagid, kind), (calls, seconds, buckets)) in \
+                sorted(self.actions.items()):
+                actions.setdefault(tag_name(tagid), {})[kind] = {
+                    "calls": calls,
+                    "seconds": seconds,
+                    "histogram": dict( (bucket_name(b), n)
+                                       for (b, n) in sorted(buckets.items()) ),
+                }
+            summary["actions"] = actions
+
+        return summary
+
+    # writes the stats to f as JSON
+    def dump(self, f):
+        import json
+        json.dump(self.summary(), f, indent=1, sort_keys=True)
+        f.write('\n')
+
+    # writes the stats to f as a table
+    def report(self, f):
+        summary = self.summary()
+        phases = summary["phases"]
+
+        f.write("%-24s %10s %10s\n" % ("phase", "wall s", "cpu s"))
+        for name in self.order + ["total"]:
+            f.write("%-24s %10.4f %10.4f\n" % (name, phases[name]["wall"],
+                                               phases[name]["cpu"]))
+
+        if len(self.counters) != 0:
+            f.write('\n')
+        for name in sorted(self.counters):
+            f.write("%-24s %10d\n" % (name, self.counters[name]))
+
+        if "peak_rss_kb" in summary:
+            f.write('\n')
+            f.write("%-24s %10d\n" % ("peak RSS kB",
+                                      summary["peak_rss_kb"]))
+            children = summary["children"]
+            if children["cpu"] != 0:
+                f.write("%-24s %10.4f\n" % ("children cpu s",
+                                            children["cpu"]))
+                f.write("%-24s %10d\n" % ("children peak RSS kB",
+                                          children["peak_rss_kb"]))
+
+        if self.profiling:
+            f.write('\n')
+            f.write("%-15s %-4s %10s %10s  %s\n" % ("tag type", "call",
+                                                    "calls", "seconds",
+                                                    "calls by microseconds"))
+            for tagname in sorted(summary["actions"]):
+                for (kind, entry) in sorted(summary["actions"][tagname].items(),
+                                            reverse=True):
+                    histogram = " ".join( "%s:%d" % (b, n) for (b, n) in
+                                          histogram_items(entry["histogram"]) )
+                    f.write("%-15s %-4s %10d %10.4f  %s\n" % (tagname, kind,
+                                                             entry["calls"],
+                                                             entry["seconds"],
+                                                             histogram))
+
+# returns: CPU seconds used by child processes that have exited, such as
+#          those of a pool started with -j
+def children_cpu():
+    if resource is None:
+        return 0.0
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return children.ru_utime + children.ru_stime
+
+def tag_name(tagid):
+    if tagid in nbt.TAGLIST:
+        return nbt.TAGLIST[tagid].__name__.lstrip('_')
+    return str(tagid)
+
+# returns: the range of microseconds in histogram bucket b, e.g. "4-8"
+def bucket_name(b):
+    if b == 0:
+        return "<1"
+    return "%d-%d" % (2 ** (b - 1), 2 ** b)
+
+# returns: the (bucket name, count) items of a histogram, fastest first
+def histogram_items(histogram):
+    def lower(item):
+        if item[0] == "<1":
+            return 0
+        return int(item[0].partition('-')[0])
+    return sorted(histogram.items(), key=lower)
@@ -0,0 +1,434 @@
+#
+#   stream.py - incremental NBT decoding
+#
+#   Copyright (C) 2012-2013 DMBuce <dmbuce@gmail.com>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with this program; if not, write to the Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import gzip
+import io
+import zlib
+from struct import Struct, error as StructError
+from nbt import nbt
+from . import arrays
+
+# events generated by EventReader.events()
+ENTER = "enter"
+LEAVE = "leave"
+VALUE = "value"
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+# size of the blocks copied by EventReader.copy()
+COPY_BLOCKSIZE = 65536
+
+# struct formats of the payloads that have a fixed size
+fixed_formats = {
+    nbt.TAG_BYTE:   Struct(">b"),
+    nbt.TAG_SHORT:  Struct(">h"),
+    nbt.TAG_INT:    Struct(">i"),
+    nbt.TAG_LONG:   Struct(">q"),
+    nbt.TAG_FLOAT:  Struct(">f"),
+    nbt.TAG_DOUBLE: Struct(">d")
+}
+
+# size of an element of the array tag types
+array_itemsizes = {
+    nbt.TAG_BYTE_ARRAY: 1,
+    nbt.TAG_INT_ARRAY:  4,
+    nbt.TAG_LONG_ARRAY: 8
+}
+
+byte_format = Struct(">b")
+ushort_format = Struct(">H")
+int_format = Struct(">i")
+list_header_format = Struct(">bi")
+
+# opens an NBT file for reading, decompressing it if it is gzipped
+def open_file(filename):
+    f = open(filename, 'rb')
+    try:
+        magic = f.read(len(GZIP_MAGIC))
+        f.seek(0)
+    except:
+        f.close()
+        raise
+
+    if magic == GZIP_MAGIC:
+        return gzip.GzipFile(fileobj=f, mode='rb')
+    else:
+        return io.BufferedReader(f)
+
+# returns: the NBT encoding of a tag's type and name
+def encode_header(tagid, name):
+    name = name.encode("utf-8")
+    return byte_format.pack(tagid) + ushort_format.pack(len(name)) + name
+
+# returns: the NBT encoding of the start of a TAG_List's payload
+def encode_list_header(tagid, length):
+    return list_header_format.pack(tagid, length)
+
+# decodes NBT data one tag at a time
+#
+# events() generates an event for each tag in the file, in depth-first order:
+#
+#     (ENTER, tagid, name, info)   a TAG_Compound or TAG_List begins
+#     (LEAVE, tagid, name, None)   a TAG_Compound or TAG_List ends
+#     (VALUE, tagid, name, None)   any other tag
+#
+# name is the tag's name, or its index if it is an element of a TAG_List. info
+# is (tagid, length) for a TAG_List and None for a TAG_Compound.
+#
+# Payloads are only decoded if asked for. Right after an event for a tag,
+# call value() to decode the payload of a leaf, load() to decode the whole
+# tag into an nbt.TAG, or skip() to skip a TAG_Compound or TAG_List. Leaves
+# whose payload isn't asked for are skipped. Tags that are loaded or skipped
+# generate no further events, not even LEAVE.
+#
+# Skipping seeks over fixed-size payloads, arrays, strings and lists of
+# fixed-size tags by their length instead of decoding them. copy() does the
+# same walk over a tag, but writes everything it reads to another file.
+class EventReader(object):
+    def __init__(self, f):
+        self.file = f
+        # (tagid, info) of the tag whose payload is at the current position,
+        # or None if it has been consumed
+        self.pending = None
+        self.skipping = False
+        # file that everything read is written to, if any
+        self.sink = None
+
+    # reads exactly n bytes
+    def read(self, n):
+        try:
+            data = self.file.read(n)
+        except (EOFError, zlib.error) as e:
+            raise IOError("Corrupt NBT data: " + str(e))
+        if len(data) != n:
+            raise IOError("Unexpected end of NBT data")
+        if self.sink is not None:
+            self.sink.write(data)
+        return data
+
+    def read_byte(self):
+        return byte_format.unpack(self.read(1))[0]
+
+    def read_int(self):
+        return int_format.unpack(self.read(4))[0]
+
+    def read_string(self):
+        length = ushort_format.unpack(self.read(2))[0]
+        return self.read(length).decode("utf-8")
+
+    # reads the header of a TAG_List payload, returns (tagid, length)
+    def read_list_header(self):
+        return (self.read_byte(), self.read_int())
+
+    # skips n bytes
+    def seek(self, n):
+        if self.sink is not None:
+            while n > 0:
+                self.read(min(n, COPY_BLOCKSIZE))
+                n -= COPY_BLOCKSIZE
+        elif n > 0:
+            try:
+                self.file.seek(n, io.SEEK_CUR)
+            except (EOFError, zlib.error) as e:
+                raise IOError("Corrupt NBT data: " + str(e))
+
+    # decodes the payload of a leaf tag
+    def read_value(self, tagid):
+        if tagid in fixed_formats:
+            fmt = fixed_formats[tagid]
+            return fmt.unpack(self.read(fmt.size))[0]
+        elif tagid == nbt.TAG_STRING:
+            return self.read_string()
+        elif tagid == nbt.TAG_BYTE_ARRAY:
+            return bytearray(self.read(self.read_int()))
+        elif tagid == nbt.TAG_INT_ARRAY:
+            return arrays.decode_ints(self.read(4 * self.read_int()))
+        elif tagid == nbt.TAG_LONG_ARRAY:
+            return arrays.decode_ints(self.read(8 * self.read_int()),
+                                      arrays.LONG_TYPECODE)
+        else:
+            raise IOError("Unknown tag type: %s" % str(tagid))
+
+    # skips the payload of a tag, given the header of a TAG_List if it has
+    # already been read
+    def skip_payload(self, tagid, info=None):
+        if tagid in fixed_formats:
+            self.seek(fixed_formats[tagid].size)
+        elif tagid == nbt.TAG_STRING:
+            self.seek(ushort_format.unpack(self.read(2))[0])
+        elif tagid in array_itemsizes:
+            self.seek(array_itemsizes[tagid] * self.read_int())
+        elif tagid == nbt.TAG_LIST:
+            if info is None:
+                info = self.read_list_header()
+            (elemtype, length) = info
+            if elemtype in fixed_formats:
+                self.seek(fixed_formats[elemtype].size * length)
+            else:
+                for i in range(length):
+                    self.skip_payload(elemtype)
+        elif tagid == nbt.TAG_COMPOUND:
+            while True:
+                childtype = self.read_byte()
+                if childtype == nbt.TAG_END:
+                    break
+                self.seek(ushort_format.unpack(self.read(2))[0])
+                self.skip_payload(childtype)
+        else:
+            raise IOError("Unknown tag type: %s" % str(tagid))
+
+    # decodes the payload of a tag into an nbt.TAG, given the header of a
+    # TAG_List if it has already been read
+    def read_payload(self, tagid, info=None):
+        if tagid not in nbt.TAGLIST or tagid == nbt.TAG_END:
+            raise IOError("Unknown tag type: %s" % str(tagid))
+
+        try:
+            if tagid == nbt.TAG_LIST and info is not None:
+                (elemtype, length) = info
+                cls = arrays.TAGLIST[elemtype]
+                tag = arrays.TAG_List(type=cls)
+                for i in range(length):
+                    tag.tags.append(cls(buffer=self.file))
+            else:
+                tag = arrays.TAGLIST[tagid](buffer=self.file)
+        except (StructError, ValueError, KeyError) as e:
+            raise IOError("Malformed NBT data: " + str(e))
+        except (EOFError, zlib.error) as e:
+            raise IOError("Corrupt NBT data: " + str(e))
+
+        return tag
+
+    # decodes the payload of the current leaf tag
+    def value(self):
+        (tagid, info) = self.pending
+        self.pending = None
+        return self.read_value(tagid)
+
+    # decodes the current tag into an nbt.TAG
+    def load(self):
+        (tagid, info) = self.pending
+        self.pending = None
+        return self.read_payload(tagid, info)
+
+    # skips the current TAG_Compound or TAG_List
+    def skip(self):
+        self.skipping = True
+
+    # writes the payload of the current tag to out without decoding it
+    def copy(self, out):
+        (tagid, info) = self.pending
+        self.pending = None
+        if tagid == nbt.TAG_LIST:
+            out.write(encode_list_header(*info))
+
+        self.sink = out
+        try:
+            self.skip_payload(tagid, info)
+        finally:
+            self.sink = None
+
+    # reads the type and name of the root tag
+    def read_root(self):
+        tagid = self.read_byte()
+        if tagid != nbt.TAG_COMPOUND:
+            raise IOError("Not an NBT file")
+        return (tagid, self.read_string())
+
+    # generates events for the root tag and its subtags
+    #
+    # If root is given, it is the (tagid, name) of a tag whose payload is at
+    # the current position, and events are generated for that tag instead of
+    # one read from the start of the file.
+    def events(self, root=None):
+        # stack: a list of [tagid, name, info, index] lists, one for each
+        #        TAG_Compound or TAG_List that has been entered but not left.
+        #        index is the index of the next element of a TAG_List
+        # child: (tagid, name) of the tag whose payload is at the current
+        #        position, or None if the next tag must be read from the
+        #        top of the stack
+        stack = []
+        if root is None:
+            child = self.read_root()
+        else:
+            child = root
+
+        while True:
+            if child is not None:
+                (tagid, name) = child
+                child = None
+
+                if tagid == nbt.TAG_LIST:
+                    info = self.read_list_header()
+                else:
+                    info = None
+
+                self.pending = (tagid, info)
+                self.skipping = False
+                if tagid == nbt.TAG_LIST or tagid == nbt.TAG_COMPOUND:
+                    yield (ENTER, tagid, name, info)
+                    if self.pending is not None:
+                        if self.skipping:
+                            self.skip_payload(tagid, info)
+                        else:
+                            stack.append( [tagid, name, info, 0] )
+                else:
+                    yield (VALUE, tagid, name, None)
+                    if self.pending is not None:
+                        self.skip_payload(tagid)
+                self.pending = None
+
+            if len(stack) == 0:
+                return
+
+            # find the next child of the top of the stack
+            top = stack[-1]
+            (tagid, name, info, index) = top
+            if tagid == nbt.TAG_COMPOUND:
+                childtype = self.read_byte()
+                if childtype != nbt.TAG_END:
+                    child = (childtype, self.read_string())
+            elif index < info[1]:
+                child = (info[0], index)
+                top[3] += 1
+
+            if child is None:
+                stack.pop()
+                yield (LEAVE, tagid, name, None)
+
+# finds a tag in an NBT file given the list of names and indexes leading to
+# it, as returned by norbert_split_name()
+#
+# Everything that isn't on the way to the tag is skipped, and the file is
+# only read up to the end of the tag.
+#
+# returns: the tag, or None if there is no such tag
+def find_tag(reader, names):
+    found = seek_tag(reader, names)
+    if found is None:
+        return None
+
+    (tagid, name, info) = found
+    return load_tag(reader, tagid, name)
+
+# finds a tag like find_tag(), but writes it to out as a named NBT tag
+# instead of decoding it. Elements of TAG_List's are given an empty name
+#
+# returns: True if the tag was found, otherwise False
+def copy_tag(reader, names, out):
+    found = seek_tag(reader, names)
+    if found is None:
+        return False
+
+    (tagid, name, info) = found
+    if isinstance(name, int):
+        name = ""
+    out.write(encode_header(tagid, name))
+    reader.copy(out)
+    return True
+
+# reads up to the tag that find_tag() looks for
+#
+# If root is given, names are looked up under the tag whose payload is at
+# the current position, as in EventReader.events().
+#
+# returns: (tagid, name, info) of the tag, with reader at the start of its
+#          payload, or None if there is no such tag
+def seek_tag(reader, names, root=None):
+    # parents: tagid and info of the tags entered so far
+    parents = []
+    events = reader.events(root)
+    for (event, tagid, name, info) in events:
+        if event == LEAVE:
+            # the tag that matched doesn't have the rest of names
+            return None
+
+        if len(parents) == 0:
+            # the root tag
+            if len(names) == 0:
+                return (tagid, name, info)
+            parents.append( (tagid, info) )
+            continue
+
+        if not name_matches(parents[-1], name, names[len(parents) - 1]):
+            if event == ENTER:
+                reader.skip()
+        elif len(parents) == len(names):
+            return (tagid, name, info)
+        elif event == ENTER:
+            parents.append( (tagid, info) )
+        else:
+            # a leaf can't have subtags
+            return None
+
+    return None
+
+# loads the current tag and gives it the name it would have in an NBTFile
+def load_tag(reader, tagid, name):
+    tag = reader.load()
+    if isinstance(name, int):
+        name = None
+    if tag.id == nbt.TAG_COMPOUND and name is None:
+        name = ""
+    tag.name = name
+    return tag
+
+# checks whether name, the name or index of a child of a tag with the given
+# (tagid, info), matches the name or index wanted by get_tag
+def name_matches(parent, name, wanted):
+    (tagid, info) = parent
+    if tagid == nbt.TAG_LIST:
+        try:
+            wanted = int(wanted)
+        except ValueError:
+            return False
+        if wanted < 0:
+            wanted += info[1]
+    return name == wanted
+
+# an NBT file that has not been read
+#
+# Tags are found with find_tag() each time get_tag() is called, without
+# building the rest of the tree.
+class NBTStream(object):
+    def __init__(self, filename):
+        self.filename = filename
+
+    def get_tag(self, names):
+        f = open_file(self.filename)
+        try:
+            return find_tag(EventReader(f), names)
+        finally:
+            f.close()
+
+    def copy_tag(self, names, out):
+        f = open_file(self.filename)
+        try:
+            return copy_tag(EventReader(f), names, out)
+        finally:
+            f.close()
+
+    # returns: the name of the root tag
+    def root_name(self):
+        f = open_file(self.filename)
+        try:
+            return EventReader(f).read_root()[1]
+        finally:
+            f.close()
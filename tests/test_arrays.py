@@ -0,0 +1,100 @@
+#
+#   test_arrays.py - tests for compact array tags
+#
+#   Copyright (C) 2012-2013 DMBuce <dmbuce@gmail.com>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with this program; if not, write to the Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import array
+import gzip
+import io
+import sys
+
+import norbert
+from nbt import nbt
+
+# writes a gzipped NBT file with int and long arrays at the root and inside
+# a TAG_List of TAG_Compound's
+def write_arrays(path):
+    root = nbt.NBTFile()
+    root.name = "Level"
+    ints = nbt.TAG_Int_Array(name="Ints")
+    ints.value = [1, -2, 2147483647]
+    root.tags.append(ints)
+    longs = nbt.TAG_Long_Array(name="Longs")
+    longs.value = [3, -4, 9223372036854775807]
+    root.tags.append(longs)
+
+    sections = nbt.TAG_List(name="Sections", type=nbt.TAG_Compound)
+    section = nbt.TAG_Compound()
+    states = nbt.TAG_Long_Array(name="BlockStates")
+    states.value = [5, 6]
+    section.tags.append(states)
+    sections.tags.append(section)
+    root.tags.append(sections)
+
+    buf = io.BytesIO()
+    root.write_file(buffer=buf)
+    with gzip.open(path, "wb") as f:
+        f.write(buf.getvalue())
+
+# reads a file the way norbert -f does
+def read_file(path, monkeypatch):
+    monkeypatch.setattr(sys, "argv", ["norbert", "-f", path])
+    (options, args) = norbert.parse_args()
+    return norbert.nbt_read_file(options)
+
+def test_read_file_arrays_are_compact(tmp_path, monkeypatch):
+    path = str(tmp_path / "arrays.dat")
+    write_arrays(path)
+    nbtfile = read_file(path, monkeypatch)
+
+    ints = nbtfile["Ints"]
+    assert isinstance(ints.value, array.array)
+    assert list(ints.value) == [1, -2, 2147483647]
+
+    longs = nbtfile["Longs"]
+    assert isinstance(longs.value, array.array)
+    assert list(longs.value) == [3, -4, 9223372036854775807]
+
+    states = nbtfile["Sections"][0]["BlockStates"]
+    assert isinstance(states.value, array.array)
+    assert list(states.value) == [5, 6]
+
+def test_stream_arrays_are_compact(tmp_path):
+    from norbert import stream
+    path = str(tmp_path / "arrays.dat")
+    write_arrays(path)
+    nbtstream = stream.NBTStream(path)
+
+    # a list is decoded from its header on, and its elements from the list
+    sections = nbtstream.get_tag(["Sections"])
+    states = sections[0]["BlockStates"]
+    assert isinstance(states.value, array.array)
+    assert list(states.value) == [5, 6]
+
+    section = nbtstream.get_tag(["Sections", 0])
+    assert isinstance(section["BlockStates"].value, array.array)
+
+def test_compact_arrays_render_unchanged(tmp_path, monkeypatch):
+    path = str(tmp_path / "arrays.dat")
+    write_arrays(path)
+    with gzip.open(path, "rb") as f:
+        data = f.read()
+
+    buf = io.BytesIO()
+    read_file(path, monkeypatch).write_file(buffer=buf)
+    assert buf.getvalue() == data
@@ -0,0 +1,78 @@
+#
+#   test_json.py - tests for the json formatter and reader
+#
+#   Copyright (C) 2012-2013 DMBuce <dmbuce@gmail.com>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with this program; if not, write to the Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import json
+import math
+import os
+import subprocess
+import sys
+
+from nbt import nbt
+
+NORBERT = os.path.join(os.path.dirname(os.path.dirname(
+                       os.path.abspath(__file__))), "norbert.py")
+
+# the values of the TAG_Float and TAG_Double written, by the end of their names
+FLOATS = {
+    "nan":    float("nan"),
+    "inf":    float("inf"),
+    "neginf": float("-inf"),
+    "half":   0.5
+}
+
+def run_norbert(*args):
+    return subprocess.run([sys.executable, NORBERT] + list(args),
+                          stdout=subprocess.PIPE, check=True,
+                          universal_newlines=True).stdout
+
+# a JSON parse_constant that rejects NaN, Infinity and -Infinity
+def reject_constant(name):
+    raise ValueError("not strict JSON: " + name)
+
+def test_nonfinite_floats_round_trip(tmp_path):
+    root = nbt.NBTFile()
+    root.name = "Level"
+    for (name, value) in FLOATS.items():
+        root.tags.append(nbt.TAG_Float(name="f" + name, value=value))
+        root.tags.append(nbt.TAG_Double(name="d" + name, value=value))
+    path = str(tmp_path / "floats.dat")
+    root.write_file(path)
+
+    text = run_norbert("-f", path, "-p", "json")
+    tags = json.loads(text, parse_constant=reject_constant)["value"]
+    assert tags["dnan"]["value"] == "NaN"
+    assert tags["finf"]["value"] == "Infinity"
+    assert tags["dneginf"]["value"] == "-Infinity"
+    assert tags["fhalf"]["value"] == 0.5
+
+    jsonpath = str(tmp_path / "floats.json")
+    with open(jsonpath, "w") as f:
+        f.write(text)
+    outpath = str(tmp_path / "out.dat")
+    run_norbert("-i", "json", "-f", jsonpath, "-o", outpath)
+
+    out = nbt.NBTFile(outpath)
+    for (name, value) in FLOATS.items():
+        for prefix in ["f", "d"]:
+            result = out[prefix + name].value
+            if math.isnan(value):
+                assert math.isnan(result)
+            else:
+                assert result == value
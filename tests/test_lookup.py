@@ -0,0 +1,45 @@
+#
+#   test_lookup.py - tests for finding tags by name
+#
+#   Copyright (C) 2012-2013 DMBuce <dmbuce@gmail.com>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with this program; if not, write to the Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import norbert
+from nbt import nbt
+
+# returns: a TAG_Compound with enough children to be searched by index
+def compound():
+    tag = nbt.TAG_Compound()
+    for i in range(2 * norbert.INDEX_MIN_TAGS):
+        tag.tags.append(nbt.TAG_Int(name="n%d" % i, value=i))
+    return tag
+
+def test_find_child_after_child_replaced_in_place():
+    tag = compound()
+    assert norbert.find_child(tag, "n3").value == 3
+
+    tag.tags[3] = nbt.TAG_Int(name="new", value=42)
+    assert norbert.find_child(tag, "new").value == 42
+    assert norbert.find_child(tag, "n3") is None
+
+def test_find_child_after_tags_reassigned():
+    tag = compound()
+    assert norbert.find_child(tag, "n0").value == 0
+
+    tag.tags = list(reversed(tag.tags))
+    assert norbert.find_child(tag, "n0").value == 0
+    assert norbert.find_child(tag, "n1").value == 1
@@ -0,0 +1,100 @@
+#
+#   test_region.py - tests for -i region
+#
+#   Copyright (C) 2012-2013 DMBuce <dmbuce@gmail.com>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with this program; if not, write to the Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import io
+import os
+import subprocess
+import sys
+
+from nbt import nbt
+from norbert import exceptions, region
+
+NORBERT = os.path.join(os.path.dirname(os.path.dirname(
+                       os.path.abspath(__file__))), "norbert.py")
+
+# the xPos of each chunk written by write_region(), by chunk index
+XPOS = { 0: 0, 1: 3, 2: 5 }
+
+def run_norbert(*args):
+    return subprocess.run([sys.executable, NORBERT] + list(args),
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                          universal_newlines=True)
+
+# writes a region file with a chunk for each entry in XPOS
+def write_region(path):
+    chunks = {}
+    for (index, xpos) in XPOS.items():
+        root = nbt.NBTFile()
+        root.name = ""
+        level = nbt.TAG_Compound(name="Level")
+        level.tags.append(nbt.TAG_Int(name="xPos", value=xpos))
+        root.tags.append(level)
+        buf = io.BytesIO()
+        root.write_file(buffer=buf)
+        chunks[index] = buf.getvalue()
+
+    with open(path, "w+b") as f:
+        f.write(b'\0' * region.HEADER_SIZE)
+        region.write_chunks(f, chunks)
+
+# returns: the xPos of each chunk in a region file, by chunk index
+def read_xpos(path):
+    regionfile = region.RegionFile(path)
+    try:
+        xpos = {}
+        for index in regionfile.chunks():
+            data = regionfile.read_chunk(index)
+            chunk = nbt.NBTFile(buffer=io.BytesIO(data))
+            xpos[index] = chunk["Level"]["xPos"].value
+        return xpos
+    finally:
+        regionfile.close()
+
+def test_query_skips_chunks_without_matches(tmp_path):
+    path = str(tmp_path / "r.0.0.mca")
+    write_region(path)
+
+    result = run_norbert("-i", "region", "-f", path, "-q", "-p", "norbert",
+                         "Level[xPos>2]/xPos")
+    assert result.returncode == 0
+    assert result.stderr == ""
+    assert result.stdout.count("chunk ") == 2
+
+def test_query_sets_only_matching_chunks(tmp_path):
+    path = str(tmp_path / "r.0.0.mca")
+    outpath = str(tmp_path / "out.mca")
+    write_region(path)
+
+    result = run_norbert("-i", "region", "-f", path, "-q",
+                         "Level[xPos>0]/xPos=9", "-o", outpath)
+    assert result.returncode == 0
+    assert result.stderr == ""
+    assert read_xpos(outpath) == { 0: 0, 1: 9, 2: 9 }
+
+def test_query_with_no_match_in_any_chunk_fails(tmp_path):
+    path = str(tmp_path / "r.0.0.mca")
+    outpath = str(tmp_path / "out.mca")
+    write_region(path)
+
+    result = run_norbert("-i", "region", "-f", path, "-q",
+                         "Level[xPos>100]/xPos=9", "-o", outpath)
+    assert result.returncode == exceptions.TAG_NOT_FOUND
+    assert result.stderr.count("No tags match") == 1
+    assert not os.path.exists(outpath)